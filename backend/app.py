@@ -1,7 +1,13 @@
 from flask import Flask
 from flask_cors import CORS
+import logging
 import os
 
+from config import DEBUG
+
+# Configure logging once for the whole application, before any module logs
+logging.basicConfig(level=logging.INFO if DEBUG else logging.WARNING)
+
 # Import routes
 from routes.conversation_routes import conversation_routes
 from routes.file_routes import file_routes
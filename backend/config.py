@@ -23,4 +23,11 @@ OPENAI_MODEL_NAME = os.environ.get('OPENAI_MODEL_NAME', 'qwen-plus')
 API_TIMEOUT = int(os.environ.get('API_TIMEOUT', '30'))
 
 # 配置调试模式
-DEBUG = os.environ.get('DEBUG', 'True').lower() in ('true', '1', 'yes') 
\ No newline at end of file
+DEBUG = os.environ.get('DEBUG', 'True').lower() in ('true', '1', 'yes')
+
+# aria2 JSON-RPC 地址（例如 http://localhost:6800/jsonrpc，需由外部以 --enable-rpc 启动aria2c）
+# 留空时每个下载任务单独启动一个aria2c进程
+ARIA2_RPC_URL = os.environ.get('ARIA2_RPC_URL', '')
+
+# aria2 RPC 密钥（对应 --rpc-secret）
+ARIA2_RPC_SECRET = os.environ.get('ARIA2_RPC_SECRET', '')
@@ -17,14 +17,15 @@ except ImportError:
 # 导入应用配置
 from config import DEBUG
 
+# 设置日志（在导入各服务之前完成，整个应用只配置一次）
+logging.basicConfig(level=logging.INFO if DEBUG else logging.WARNING)
+
 # 服务导入
 from services.chat_service import AIService
 from services.conversation_service import ConversationService
 from services.pipeline_service import PipelineService
 # LLM相关导入和配置已移除
 
-# 设置日志
-logging.basicConfig(level=logging.INFO if DEBUG else logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # LLM相关配置状态日志已移除
@@ -5,8 +5,7 @@ from services.conversation_service import ConversationService
 from services.chat_service import AIService
 from services.pipeline_service import PipelineService
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Logging is configured by the application entry point
 logger = logging.getLogger(__name__)
 
 # Create Blueprint
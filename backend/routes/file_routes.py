@@ -1,4 +1,4 @@
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, request, jsonify, send_file, Response
 import os
 import logging
 from werkzeug.utils import secure_filename
@@ -6,8 +6,7 @@ from services.file_service import FileService
 import mimetypes
 import time
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Logging is configured by the application entry point
 logger = logging.getLogger(__name__)
 
 # Create Blueprint
@@ -282,13 +281,13 @@ def download_batch_files():
         
         timestamp = time.strftime("%Y%m%d-%H%M%S")
         zip_filename = f"batch_download_{conversation_id}_{timestamp}.zip"
-        logger.info(f"Zip created, serving as {zip_filename}")
+        logger.info(f"Streaming zip as {zip_filename}")
         
-        return send_file(
+        # 边压缩边发送，不在内存中生成完整的压缩包
+        return Response(
             zip_stream,
-            as_attachment=True,
-            download_name=zip_filename,
-            mimetype='application/zip'
+            mimetype='application/zip',
+            headers={'Content-Disposition': f'attachment; filename="{zip_filename}"'}
         )
     except FileNotFoundError as e:
         logger.error(f"File not found during zip creation: {e}")
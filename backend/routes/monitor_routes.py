@@ -2,8 +2,7 @@ from flask import Blueprint, request, jsonify
 import logging
 from services.monitor_service import MonitorService
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+# 日志由应用入口统一配置，这里只获取模块logger
 logger = logging.getLogger(__name__)
 
 # 创建蓝图
@@ -5,8 +5,7 @@ from services.pipeline_service import PipelineService
 from services.file_service import FileService
 from services.chat_service import AIService
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Logging is configured by the application entry point
 logger = logging.getLogger(__name__)
 
 # Create Blueprint
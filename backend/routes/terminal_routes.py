@@ -4,8 +4,7 @@ from services.terminal_service import TerminalService
 import time
 import traceback
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+# 日志由应用入口统一配置，这里只获取模块logger
 logger = logging.getLogger(__name__)
 
 # 创建蓝图
@@ -57,6 +56,19 @@ def get_terminal_session(session_id):
         logger.error(f"获取终端会话详情错误: {str(e)}\n{traceback.format_exc()}")
         return jsonify({'error': f"获取终端会话详情失败: {str(e)}"}), 500
 
+@terminal_routes.route('/terminal/sessions/<session_id>/commands/<command_id>/output', methods=['GET'])
+def get_command_output(session_id, command_id):
+    """获取命令输出，plain=1时返回去除ANSI颜色代码的纯文本"""
+    try:
+        plain = request.args.get('plain') in ('1', 'true')
+        output = terminal_service.get_command_output(session_id, command_id, plain=plain)
+        return jsonify({'id': command_id, 'output': output})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        logger.error(f"获取命令输出错误: {str(e)}\n{traceback.format_exc()}")
+        return jsonify({'error': f"获取命令输出失败: {str(e)}"}), 500
+
 @terminal_routes.route('/terminal/sessions/<session_id>/execute', methods=['POST'])
 def execute_command(session_id):
     """执行终端命令"""
@@ -79,39 +91,17 @@ def execute_command(session_id):
 def terminate_command(session_id, command_id):
     """终止正在执行的命令"""
     try:
-        success = False
-        terminated_processes = []
-        
-        # 查找与命令相关的进程
-        for pid, proc_info in list(terminal_service.active_processes.items()):
-            if (proc_info['session_id'] == session_id and 
-                proc_info['command_id'] == command_id):
-                try:
-                    # 终止进程组
-                    import os
-                    import signal
-                    os.killpg(proc_info['process_group'], signal.SIGTERM)
-                    # 等待一小段时间后再发送强制终止信号
-                    time.sleep(0.5)
-                    if proc_info['process'].poll() is None:
-                        os.killpg(proc_info['process_group'], signal.SIGKILL)
-                    
-                    terminated_processes.append(pid)
-                    success = True
-                except Exception as e:
-                    logger.error(f"终止命令进程错误: {str(e)}\n{traceback.format_exc()}")
-                    # 尝试直接终止进程
-                    try:
-                        proc_info['process'].kill()
-                        terminated_processes.append(pid)
-                        success = True
-                    except:
-                        pass
+        # 查找与命令相关的进程并终止
+        procs = [
+            (pid, proc_info) for pid, proc_info in terminal_service.session_processes(session_id)
+            if proc_info['command_id'] == command_id
+        ]
+        terminated_processes = terminal_service.terminate_processes(procs)
+        success = bool(terminated_processes)
         
         # 从活跃进程列表中移除已终止的进程
         for pid in terminated_processes:
-            if pid in terminal_service.active_processes:
-                del terminal_service.active_processes[pid]
+            terminal_service.remove_process(pid)
         
         # 更新命令状态
         if success:
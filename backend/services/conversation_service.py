@@ -1,12 +1,23 @@
 import os
+import re
 import json
 import uuid
+import tempfile
+import threading
+import queue
+import atexit
+import copy
 from datetime import datetime
 import logging
+from concurrent.futures import Future
+from string import Template
 from typing import Dict, List, Any, Optional
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+try:
+    import orjson
+except ImportError:
+    orjson = None  # orjson不可用，使用标准库json
+
 logger = logging.getLogger(__name__)
 
 # Data directories
@@ -16,6 +27,161 @@ CONVERSATIONS_DIR = os.path.join(DATA_DIR, 'conversations')
 # Ensure directories exist
 os.makedirs(CONVERSATIONS_DIR, exist_ok=True)
 
+def _dumps(obj: Any) -> bytes:
+    """Serialize a conversation to JSON bytes (orjson when available)"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    # 缩进输出是标准库json最慢的路径，会话文件不需要人工编辑，使用紧凑格式
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _loads(data: bytes) -> Any:
+    """Parse JSON bytes (orjson when available)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _write_conversation(conversation: Dict) -> None:
+    """Atomically write a conversation to its JSON file"""
+    filepath = os.path.join(CONVERSATIONS_DIR, f"{conversation['id']}.json")
+    
+    data = _dumps(conversation)
+    
+    # 先写临时文件再原子替换，避免写到一半崩溃导致会话文件被截断
+    fd, tmp_path = tempfile.mkstemp(dir=CONVERSATIONS_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+# 后台写盘：待保存的会话按ID合并，只保留最新一份，写完才移除
+_pending_saves: Dict[str, Dict] = {}
+_pending_lock = threading.Lock()
+_write_lock = threading.Lock()  # 串行化写盘与删除
+_save_queue = queue.Queue()
+
+def _write_pending(conversation_id: str) -> None:
+    """Write the latest pending copy of a conversation, if any"""
+    with _write_lock:
+        with _pending_lock:
+            conversation = _pending_saves.get(conversation_id)
+        if conversation is None:
+            return
+        try:
+            _write_conversation(conversation)
+        except Exception as e:
+            logger.error(f"Error saving conversation {conversation_id}: {e}")
+        with _pending_lock:
+            # 写盘期间可能又有新的保存请求，只移除已写入的那一份
+            if _pending_saves.get(conversation_id) is conversation:
+                del _pending_saves[conversation_id]
+
+def _save_writer() -> None:
+    """Background thread draining the save queue"""
+    while True:
+        _write_pending(_save_queue.get())
+
+def _flush_pending_saves() -> None:
+    """Write every pending conversation synchronously (used at exit)"""
+    with _pending_lock:
+        conversation_ids = list(_pending_saves)
+    for conversation_id in conversation_ids:
+        _write_pending(conversation_id)
+
+threading.Thread(target=_save_writer, name='conversation-writer', daemon=True).start()
+atexit.register(_flush_pending_saves)
+
+# Maximum number of parallel_safe workflow steps run at the same time
+MAX_PARALLEL_STEPS = 4
+
+# 常见意图的关键词预筛选，命中时无需调用LLM进行意图分类（按顺序匹配）
+# MODIFY/EXECUTE 会直接改动或运行工作流，只匹配以祈使动词开头的消息
+_INTENT_PATTERNS = [
+    (re.compile(r'\b(create|build|generate|design)\b.*\b(pipelines?|workflows?)\b|(生成|创建|新建|设计).*(流程|工作流|pipeline|workflow)', re.I), 'CREATE'),
+    (re.compile(r'^\s*(please\s+)?(modify|change|edit|adjust)\b|^\s*请?(修改|调整|更改)', re.I), 'MODIFY'),
+    (re.compile(r'^\s*(please\s+)?(run|execute)\b|^\s*请?(运行|执行)', re.I), 'EXECUTE'),
+]
+# 提问形式的消息（问号结尾、疑问词开头或含中文疑问词）不做预筛选，交给LLM判断
+_QUESTION_RE = re.compile(
+    r'[?？]\s*$'
+    r'|^\s*(how|what|why|when|where|which|who|can|could|should|would|is|are|does|do|did)\b'
+    r'|怎么|怎样|如何|为什么|什么|是否|能否|吗\s*$|呢\s*$',
+    re.I
+)
+
+# Prompt templates (compiled once at import, only the variable fields are substituted per call)
+_CHAT_TPL = Template("""
+            You are in CHAT MODE. The user is asking questions about bioinformatics.
+            Your goal is to answer their questions without automatically planning or executing workflows.
+            If they want to run an analysis, suggest they switch to Agent Mode.
+            
+            Here is the recent conversation history:
+            $history
+            
+            Provide a helpful answer about bioinformatics concepts, tools, or techniques.
+            """)
+
+# 分析用户意图
+_ANALYSIS_TPL = Template("""
+            分析用户在Agent模式下的请求，基于对话历史和当前消息。
+            
+            当前消息: "$message"
+            
+            历史消息:
+            $history
+            
+            请确定用户的意图:
+            1. CREATE - 用户想要创建新的工作流
+            2. MODIFY - 用户想要修改现有工作流
+            3. EXECUTE - 用户想要执行工作流或某些步骤
+            4. QUESTION - 用户只是提问，不需要工作流操作
+            
+            只回答一个单词: CREATE, MODIFY, EXECUTE 或 QUESTION
+            """)
+
+# 修改工作流
+_MODIFICATION_TPL = Template("""
+                        用户请求: "$message"
+                        
+                        当前工作流:
+                        标题: $title
+                        
+                        步骤:
+                        $steps
+                        
+                        可用文件:
+                        $files
+                        
+                        分析用户的请求，并解释他们想要对工作流进行哪些修改。
+                        如果需要，提供修改后的工作流步骤。
+                        """)
+
+# 选择要执行的步骤
+_EXECUTION_TPL = Template("""
+                        用户请求: "$message"
+                        
+                        当前工作流:
+                        标题: $title
+                        
+                        步骤:
+                        $steps
+                        
+                        用户想要执行哪个步骤? 请提供步骤ID或步骤编号(如step1)。如果用户想要执行全部步骤，请回答"ALL"。
+                        只回答步骤ID或"ALL"，不要其他解释。
+                        """)
+
+# 一般问题
+_QUESTION_TPL = Template("""
+                用户在Agent模式下问了一个问题: "$message"
+                
+                工作目录中的文件:
+                $files
+                
+                请提供一个有关生物信息学领域的专业回复。如果问题与文件管理或工作流相关，可提供相关建议。
+                """)
+
 class ConversationService:
     """Service for managing conversations and messages"""
     
@@ -30,36 +196,50 @@ class ConversationService:
         
         if not os.path.exists(CONVERSATIONS_DIR):
             return conversations
+        
+        # 尚未落盘的会话以内存中的最新版本为准
+        with _pending_lock:
+            pending = list(_pending_saves.values())
+        pending_ids = {conversation['id'] for conversation in pending}
+        loaded = list(pending)
             
         for filename in os.listdir(CONVERSATIONS_DIR):
-            if filename.endswith('.json'):
+            if filename.endswith('.json') and filename[:-5] not in pending_ids:
                 filepath = os.path.join(CONVERSATIONS_DIR, filename)
                 try:
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        conversation = json.load(f)
-                        conversations.append({
-                            'id': conversation.get('id', ''),
-                            'title': conversation.get('title', 'Untitled Conversation'),
-                            'created_at': conversation.get('created_at', ''),
-                            'updated_at': conversation.get('updated_at', ''),
-                            'mode': conversation.get('mode', 'chat'),
-                            'message_count': len(conversation.get('messages', []))
-                        })
+                    with open(filepath, 'rb') as f:
+                        loaded.append(_loads(f.read()))
                 except Exception as e:
                     logger.error(f"Error reading conversation file {filename}: {e}")
         
+        for conversation in loaded:
+            conversations.append({
+                'id': conversation.get('id', ''),
+                'title': conversation.get('title', 'Untitled Conversation'),
+                'created_at': conversation.get('created_at', ''),
+                'updated_at': conversation.get('updated_at', ''),
+                'mode': conversation.get('mode', 'chat'),
+                'message_count': len(conversation.get('messages', []))
+            })
+        
         # Sort by updated_at in descending order
         return sorted(conversations, key=lambda x: x.get('updated_at', ''), reverse=True)
     
     def get_conversation(self, conversation_id: str) -> Dict:
         """Get a specific conversation"""
+        with _pending_lock:
+            pending = _pending_saves.get(conversation_id)
+        if pending is not None:
+            # 返回副本，调用方修改时不影响后台线程正在序列化的对象
+            return copy.deepcopy(pending)
+        
         filepath = os.path.join(CONVERSATIONS_DIR, f"{conversation_id}.json")
         
         if not os.path.exists(filepath):
             raise FileNotFoundError(f"Conversation {conversation_id} not found")
             
-        with open(filepath, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open(filepath, 'rb') as f:
+            return _loads(f.read())
     
     def create_conversation(self, title: Optional[str] = None, mode: str = 'chat') -> Dict:
         """Create a new conversation"""
@@ -103,10 +283,14 @@ class ConversationService:
         """Delete a conversation"""
         filepath = os.path.join(CONVERSATIONS_DIR, f"{conversation_id}.json")
         
-        if not os.path.exists(filepath):
-            return False
+        with _write_lock:
+            with _pending_lock:
+                pending = _pending_saves.pop(conversation_id, None)
             
-        os.remove(filepath)
+            if not os.path.exists(filepath):
+                return pending is not None
+                
+            os.remove(filepath)
         return True
     
     def rename_conversation(self, conversation_id: str, title: str) -> Dict:
@@ -249,16 +433,8 @@ class ConversationService:
         
         # Use AI service to generate response
         try:
-            prompt = f"""
-            You are in CHAT MODE. The user is asking questions about bioinformatics.
-            Your goal is to answer their questions without automatically planning or executing workflows.
-            If they want to run an analysis, suggest they switch to Agent Mode.
-            
-            Here is the recent conversation history:
-            {''.join([f"{'Bot' if msg['role'] == 'assistant' else 'User'}: {msg['content']}\n" for msg in formatted_history])}
-            
-            Provide a helpful answer about bioinformatics concepts, tools, or techniques.
-            """
+            history_text = self._format_history(formatted_history)
+            prompt = _CHAT_TPL.substitute(history=history_text)
             
             response_text = self.ai_service.generate_response(prompt)
             if not response_text:
@@ -298,45 +474,36 @@ class ConversationService:
                     'content': msg.get('text', '')
                 })
             
-            # 分析请求，判断用户意图
-            analysis_prompt = f"""
-            分析用户在Agent模式下的请求，基于对话历史和当前消息。
-            
-            当前消息: "{message_text}"
-            
-            历史消息:
-            {''.join([f"{'Bot' if msg['role'] == 'assistant' else 'User'}: {msg['content']}\n" for msg in formatted_history[:-1]])}
-            
-            请确定用户的意图:
-            1. CREATE - 用户想要创建新的工作流
-            2. MODIFY - 用户想要修改现有工作流
-            3. EXECUTE - 用户想要执行工作流或某些步骤
-            4. QUESTION - 用户只是提问，不需要工作流操作
-            
-            只回答一个单词: CREATE, MODIFY, EXECUTE 或 QUESTION
-            """
-            
-            intent = self.ai_service.generate_response(analysis_prompt).strip().upper()
-            logger.info(f"Agent mode intent analysis: {intent}")
+            # 分析请求，判断用户意图（关键词未命中时才请求LLM）
+            intent = self._match_intent(message_text)
+            if intent:
+                logger.info(f"Agent mode intent matched by keywords: {intent}")
+            else:
+                history_text = self._format_history(formatted_history[:-1])
+                analysis_prompt = _ANALYSIS_TPL.substitute(message=message_text, history=history_text)
+                
+                intent = self.ai_service.generate_response(analysis_prompt).strip().upper()
+                logger.info(f"Agent mode intent analysis: {intent}")
             
             # 获取工作目录的文件列表，以提供给AI参考
             try:
-                from os import listdir, path
                 files_dir = self.pipeline_service.get_conversation_files_dir(conversation_id)
                 
                 available_files = []
-                if path.exists(files_dir):
-                    for filename in listdir(files_dir):
-                        file_path = path.join(files_dir, filename)
-                        if path.isfile(file_path):
-                            file_type = filename.split('.')[-1] if '.' in filename else 'unknown'
-                            available_files.append({
-                                'name': filename,
-                                'path': filename,
-                                'type': file_type
-                            })
+                if os.path.isdir(files_dir):
+                    # scandir 的 DirEntry 复用目录项中的类型信息，无需逐个 stat
+                    with os.scandir(files_dir) as it:
+                        for entry in it:
+                            if entry.is_file():
+                                filename = entry.name
+                                file_type = filename.rsplit('.', 1)[-1] if '.' in filename else 'unknown'
+                                available_files.append({
+                                    'name': filename,
+                                    'path': filename,
+                                    'type': file_type
+                                })
                 
-                files_context = "\n".join([f"- {f['name']} ({f['type']})" for f in available_files])
+                files_context = '\n'.join(f"- {f['name']} ({f['type']})" for f in available_files)
                 if not files_context:
                     files_context = "No files available"
             except Exception as e:
@@ -352,15 +519,16 @@ class ConversationService:
                     recent_workflows = self.pipeline_service.list_workflows(conversation_id)
                     workflows_context = ""
                     if recent_workflows:
-                        workflows_context = "最近的工作流:\n" + "\n".join([
+                        workflows_context = "最近的工作流:\n" + '\n'.join(
                             f"- {w['title']} (ID: {w['id']}, 状态: {w['status']})" 
                             for w in recent_workflows[:3]
-                        ])
+                        )
 
                     # 为 pipeline_service.create_workflow 添加日志
                     logger.info(f"Attempting to create workflow for conversation_id: {conversation_id}")
                     logger.info(f"Goal for workflow creation: '{message_text}'")
-                    logger.info(f"Available files for workflow creation: {available_files}")
+                    if logger.isEnabledFor(logging.INFO):
+                        logger.info(f"Available files for workflow creation: {available_files}")
 
                     # 创建工作流
                     workflow = self.pipeline_service.create_workflow(
@@ -369,7 +537,8 @@ class ConversationService:
                         files=available_files
                     )
 
-                    logger.info(f"Workflow object received from pipeline_service: {workflow}")
+                    if logger.isEnabledFor(logging.INFO):
+                        logger.info(f"Workflow object received from pipeline_service: {workflow}")
 
                     if not workflow or not isinstance(workflow, dict):
                         logger.error(f"Pipeline service returned invalid workflow object: {workflow} for conversation {conversation_id} when creating a new workflow.")
@@ -438,9 +607,9 @@ class ConversationService:
                                 final_response_text = "已成功启动工作流创建。请在 Pipeline 面板中查看详细信息。"
                 
                 except Exception as e:
-                    logger.error(f"Error creating workflow: {e}", exc_info=True)
-                    error_message = str(e)
-                    final_response_text = f"抱歉，创建工作流时出错: {error_message if error_message and error_message.strip() else '发生未知错误，无法显示具体信息。'}"
+                    error_message = str(e).strip() or '发生未知错误，无法显示具体信息。'
+                    logger.error("Error creating workflow: %s", error_message, exc_info=True)
+                    final_response_text = f"抱歉，创建工作流时出错: {error_message}"
                     # workflow_id_for_message 保持 None 或其在try块中可能被赋予的值
 
                 # 确保总是有回复文本
@@ -468,21 +637,12 @@ class ConversationService:
                         current_workflow = self.pipeline_service.get_workflow(workflows[0]['id'])
                         
                         # 创建修改提示
-                        modification_prompt = f"""
-                        用户请求: "{message_text}"
-                        
-                        当前工作流:
-                        标题: {current_workflow.get('title')}
-                        
-                        步骤:
-                        {chr(10).join([f"步骤 {i+1}: {step.get('title')} - {step.get('command')}" for i, step in enumerate(current_workflow.get('steps', []))])}
-                        
-                        可用文件:
-                        {files_context}
-                        
-                        分析用户的请求，并解释他们想要对工作流进行哪些修改。
-                        如果需要，提供修改后的工作流步骤。
-                        """
+                        modification_prompt = _MODIFICATION_TPL.substitute(
+                            message=message_text,
+                            title=current_workflow.get('title'),
+                            steps='\n'.join(self._format_step_lines(current_workflow.get('steps', []))),
+                            files=files_context
+                        )
                         
                         analysis = self.ai_service.generate_response(modification_prompt)
                         
@@ -515,44 +675,31 @@ class ConversationService:
                         bot_message = self.add_bot_message(conversation_id, response_text)
                     else:
                         current_workflow = self.pipeline_service.get_workflow(workflows[0]['id'])
+                        steps = current_workflow.get('steps', [])
+                        steps_by_id = {step['id']: step for step in steps}
                         
                         # 分析用户想执行哪个步骤
-                        execution_prompt = f"""
-                        用户请求: "{message_text}"
-                        
-                        当前工作流:
-                        标题: {current_workflow.get('title')}
-                        
-                        步骤:
-                        {chr(10).join([f"步骤 {i+1} ({step.get('id')}): {step.get('title')} - {step.get('command')}" for i, step in enumerate(current_workflow.get('steps', []))])}
-                        
-                        用户想要执行哪个步骤? 请提供步骤ID或步骤编号(如step1)。如果用户想要执行全部步骤，请回答"ALL"。
-                        只回答步骤ID或"ALL"，不要其他解释。
-                        """
+                        execution_prompt = _EXECUTION_TPL.substitute(
+                            message=message_text,
+                            title=current_workflow.get('title'),
+                            steps='\n'.join(self._format_step_lines(steps, with_ids=True))
+                        )
                         
                         step_to_execute = self.ai_service.generate_response(execution_prompt).strip()
                         
                         if step_to_execute.upper() == "ALL":
-                            # 依次执行所有步骤
+                            # 依次执行所有步骤，相邻的 parallel_safe 步骤并发执行
                             executed_steps = []
                             failed_steps = []
                             
-                            for step in current_workflow.get('steps', []):
-                                try:
-                                    executed_step = self.pipeline_service.execute_step(
-                                        current_workflow['id'],
-                                        step['id'],
-                                        conversation_id
-                                    )
+                            for batch in self._group_parallel_steps(steps):
+                                for executed_step in self._execute_step_batch(current_workflow['id'], batch, conversation_id):
                                     if executed_step.get('status') == 'completed':
                                         executed_steps.append(executed_step)
                                     else:
                                         failed_steps.append(executed_step)
-                                        # 如果步骤失败，停止执行后续步骤
-                                        break
-                                except Exception as step_error:
-                                    logger.error(f"Error executing step {step['id']}: {step_error}")
-                                    failed_steps.append({'id': step['id'], 'error': str(step_error), 'title': step.get('title', step['id'])})
+                                # 如果步骤失败，停止执行后续步骤
+                                if failed_steps:
                                     break
                             
                             # 构建回复
@@ -562,7 +709,7 @@ class ConversationService:
 
 错误信息: {failed_step.get('error', '未知错误')}
 
-已成功执行 {len(executed_steps)} 个步骤，1个步骤失败。请检查错误信息并修改工作流。
+已成功执行 {len(executed_steps)} 个步骤，{len(failed_steps)}个步骤失败。请检查错误信息并修改工作流。
 """
                             else:
                                 response_text = f"""已成功执行全部 {len(executed_steps)} 个工作流步骤。
@@ -571,7 +718,7 @@ class ConversationService:
 """
                         else:
                             # 执行特定步骤
-                            step_ids = [step['id'] for step in current_workflow.get('steps', [])]
+                            step_ids = list(steps_by_id)
                             step_id = None
                             # 允许用户输入步骤ID或者步骤编号(1,2,3等)
                             if step_to_execute in step_ids:
@@ -604,7 +751,7 @@ class ConversationService:
                                 )
                                 
                                 # 找到步骤的标题
-                                step_title = next((step['title'] for step in current_workflow.get('steps', []) if step['id'] == step_id), step_id)
+                                step_title = steps_by_id.get(step_id, {}).get('title', step_id)
                                 
                                 if executed_step.get('status') == 'completed':
                                     response_text = f"""已成功执行步骤 "{step_title}":
@@ -646,14 +793,7 @@ class ConversationService:
             
             else:  # QUESTION or unknown intent
                 # 处理一般问题
-                question_prompt = f"""
-                用户在Agent模式下问了一个问题: "{message_text}"
-                
-                工作目录中的文件:
-                {files_context}
-                
-                请提供一个有关生物信息学领域的专业回复。如果问题与文件管理或工作流相关，可提供相关建议。
-                """
+                question_prompt = _QUESTION_TPL.substitute(message=message_text, files=files_context)
                 response_text = self.ai_service.generate_response(question_prompt)
                 if not response_text:
                     logger.warning(f"AI service returned empty response for agent question in conversation {conversation_id}")
@@ -670,9 +810,68 @@ class ConversationService:
             'ai_message': bot_message
         }
     
+    def _match_intent(self, message_text: str) -> Optional[str]:
+        """Classify common agent-mode requests by keywords, None if the LLM has to decide"""
+        if _QUESTION_RE.search(message_text):
+            return None
+        for pattern, intent in _INTENT_PATTERNS:
+            if pattern.search(message_text):
+                return intent
+        return None
+    
+    def _group_parallel_steps(self, steps: List[Dict]) -> List[List[Dict]]:
+        """Group consecutive steps marked parallel_safe into batches; other steps run alone"""
+        batches = []
+        for step in steps:
+            if step.get('parallel_safe') and batches and batches[-1][0].get('parallel_safe'):
+                batches[-1].append(step)
+            else:
+                batches.append([step])
+        return batches
+    
+    def _execute_step_batch(self, plan_id: str, batch: List[Dict], conversation_id: str) -> List[Dict]:
+        """Execute a batch of steps, concurrently when it holds more than one step"""
+        def failed(step: Dict, step_error: Exception) -> Dict:
+            logger.error(f"Error executing step {step['id']}: {step_error}")
+            return {'id': step['id'], 'status': 'failed', 'error': str(step_error), 'title': step.get('title', step['id'])}
+        
+        # 步骤进程由pipeline_service的回收线程统一等待，这里只需启动并收集结果，不再为每个步骤占用线程
+        results = []
+        for i in range(0, len(batch), MAX_PARALLEL_STEPS):
+            started = []
+            for step in batch[i:i + MAX_PARALLEL_STEPS]:
+                try:
+                    future = self.pipeline_service.start_step(plan_id, step['id'], conversation_id)
+                except Exception as step_error:
+                    future = Future()
+                    future.set_exception(step_error)
+                started.append((step, future))
+            
+            for step, future in started:
+                try:
+                    results.append(future.result())
+                except Exception as step_error:
+                    results.append(failed(step, step_error))
+        return results
+    
+    def _format_history(self, formatted_history: List[Dict]) -> str:
+        """Render formatted history as "Bot: ..." / "User: ..." lines for prompts"""
+        return ''.join(
+            f"{'Bot' if msg['role'] == 'assistant' else 'User'}: {msg['content']}\n"
+            for msg in formatted_history
+        )
+    
+    def _format_step_lines(self, steps: List[Dict], with_ids: bool = False) -> List[str]:
+        """Render workflow steps as one prompt line per step"""
+        if with_ids:
+            return [
+                f"步骤 {i+1} ({step.get('id')}): {step.get('title')} - {step.get('command')}"
+                for i, step in enumerate(steps)
+            ]
+        return [f"步骤 {i+1}: {step.get('title')} - {step.get('command')}" for i, step in enumerate(steps)]
+    
     def _save_conversation(self, conversation: Dict) -> None:
-        """Save conversation to file"""
-        filepath = os.path.join(CONVERSATIONS_DIR, f"{conversation['id']}.json")
-        
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(conversation, f, ensure_ascii=False, indent=2)
+        """Queue a conversation for saving on the background writer thread"""
+        with _pending_lock:
+            _pending_saves[conversation['id']] = conversation
+        _save_queue.put(conversation['id'])
@@ -1,19 +1,25 @@
 import os
+import asyncio
+import re
 import shutil
+import stat
 import json
 import mimetypes
-from typing import Dict, List, Any, Optional
+import io
+from typing import Dict, List, Any, Optional, Tuple, Iterator
 import logging
-import uuid
 import subprocess
 import threading
 import time
 import zipfile
-import io
 import signal  # Add signal module for process control
+import urllib.request
+import itertools
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from config import ARIA2_RPC_URL, ARIA2_RPC_SECRET
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Logging is configured by the application entry point
 logger = logging.getLogger(__name__)
 
 # Data directories
@@ -25,34 +31,234 @@ DOWNLOADS_DIR = os.path.join(DATA_DIR, 'downloads')  # 下载目录
 os.makedirs(FILES_DIR, exist_ok=True)
 os.makedirs(DOWNLOADS_DIR, exist_ok=True)  # 确保下载目录存在
 
+# aria2c 下载参数（进程模式下转为命令行参数，RPC模式下作为 addUri 选项）
+ARIA2_OPTIONS = {
+    'file-allocation': 'none',
+    'max-connection-per-server': '5',
+    'max-tries': '5',
+    'retry-wait': '5',
+    'connect-timeout': '60',
+}
+
+# 解析aria2c输出时读取的日志末尾字节数
+ARIA2_LOG_TAIL = 64 * 1024
+# 直接匹配原始字节；兼容 "1.2MiB (1,234,567 bytes)" 与纯字节数 "5B" 两种格式
+_TOTAL_LENGTH_RE = re.compile(rb'Total Length:\s*(?:[^(\n]*\(([\d,]+)\s*(?:bytes)?\)|([\d,]+)B\b)')
+
+# 有进行中的下载时，检查进度的间隔（秒）
+MONITOR_INTERVAL = 1.0
+# 自适应检查间隔：速度变化明显时缩短到下限，平稳时逐步放宽到上限
+MONITOR_INTERVAL_MIN = 0.25
+MONITOR_INTERVAL_MAX = 5.0
+MONITOR_SETTLE_RATIO = 0.05  # 速度相对变化低于该比例视为平稳
+# 下载速度指数移动平均的平滑因子
+SPEED_EMA_ALPHA = 0.3
+SPEED_EMA_KEEP = 1 - SPEED_EMA_ALPHA
+
+# 下载状态分段锁的数量
+DOWNLOAD_LOCK_STRIPES = 16
+
+# 上传时流式拷贝的块大小
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# 打包下载时每次读取的块大小
+ZIP_CHUNK_SIZE = 64 * 1024
+
+# 打包时deflate使用的压缩级别（最快）
+ZIP_COMPRESS_LEVEL = 1
+# zf.open(ZipInfo) 只读取ZipInfo上的压缩级别：Python 3.13 起为公开的 compress_level，更早的版本为 _compresslevel
+_ZIPINFO_LEVEL_ATTR = 'compress_level' if hasattr(zipfile.ZipInfo, 'compress_level') else '_compresslevel'
+
+# 已压缩的文件格式，打包时不再压缩
+COMPRESSED_EXTENSIONS = ('.gz', '.bam', '.cram', '.bcf', '.bw', '.bigwig', '.zip', '.bz2', '.xz', '.pdf')
+
+# 列表节点ID计数器（仅需在进程内唯一，无需uuid4的随机数）
+_ID_COUNTER = itertools.count()
+
+# 进程启动时间前缀，使下载ID在重启后也不会与之前的重复
+_ID_EPOCH = f"{int(time.time()):x}"
+
+def _new_id(prefix: str) -> str:
+    """Generate a process-unique id for a file tree node"""
+    return f"{prefix}-{next(_ID_COUNTER):08x}"
+
+def _stream_fileno(stream) -> Optional[int]:
+    """Return the OS file descriptor backing an upload stream, or None if it is in memory"""
+    # 内存中的流（BytesIO等）抛出 io.UnsupportedOperation，此时回退到普通拷贝；
+    # 尚未落盘的SpooledTemporaryFile会在此写入临时文件，其大小不超过spool上限，代价很小
+    try:
+        return stream.fileno()
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        return None
+
+# 子目录并发扫描的线程池（目录读取以等待I/O为主，线程即可重叠延迟）
+_SCAN_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix='dir-scan')
+
+class _ZipStreamSink:
+    """Write-only file object that buffers zip output until it is drained"""
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self) -> None:
+        pass
+    
+    def drain(self) -> List[bytes]:
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+# 目录列表排序键
+_BY_NAME = itemgetter('name')
+
+# 扩展名 -> 文件类型
+EXT_MAP = {
+    # Bioinformatics file types
+    'fastq': 'fastq', 'fq': 'fastq',
+    'fasta': 'fasta', 'fa': 'fasta', 'fna': 'fasta', 'faa': 'fasta',
+    'sam': 'alignment', 'bam': 'alignment', 'cram': 'alignment',
+    'vcf': 'variant', 'bcf': 'variant',
+    'gtf': 'annotation', 'gff': 'annotation', 'gff3': 'annotation',
+    'bed': 'genomic', 'bedgraph': 'genomic', 'bigwig': 'genomic', 'bw': 'genomic',
+    # Programming languages
+    'py': 'python',
+    'r': 'r', 'rmd': 'r',
+    'sh': 'shell',
+    'pl': 'perl', 'pm': 'perl',
+    # Documents & Data
+    'txt': 'text', 'md': 'text', 'log': 'text',
+    'csv': 'tabular', 'tsv': 'tabular',
+    'json': 'json',
+    'xml': 'xml',
+    'pdf': 'pdf',
+}
+
+# 压缩的双扩展名 -> 文件类型
+COMPOUND_MAP = {
+    'fastq.gz': 'fastq', 'fq.gz': 'fastq',
+    'fasta.gz': 'fasta', 'fa.gz': 'fasta',
+    'vcf.gz': 'variant',
+}
+
+# 所有已知扩展名合并为一个正则，一次C层匹配即可取得扩展名（长的在前，双扩展名优先）
+EXT_TYPE_MAP = {**EXT_MAP, **COMPOUND_MAP}
+EXT_PATTERN = re.compile(
+    r'(?i)\.(' + '|'.join(re.escape(ext) for ext in sorted(EXT_TYPE_MAP, key=len, reverse=True)) + r')$'
+)
+
+# 可直接判定为文本/二进制的类型，其余类型（如 alignment 既有 sam 也有 bam）再查 mimetypes
+_TEXT_TYPES = frozenset({
+    'python', 'r', 'shell', 'perl', 'text', 'tabular', 'json', 'xml',
+    'fasta', 'fastq', 'annotation',
+})
+_BINARY_TYPES = frozenset({'pdf'})
+
+# 启动时加载一次 mime 数据库，避免首个请求时再解析
+mimetypes.init()
+
 class FileService:
     """Service for managing files and directories"""
     
+    # 文件树缓存有效期（秒）；mtime只反映顶层变化，子目录变化依赖过期或写操作失效
+    TREE_CACHE_TTL = 2.0
+    
+    # 同一层子目录数不少于该值时才使用线程池并发扫描，避免小目录付出提交开销
+    PARALLEL_SCAN = True
+    PARALLEL_SCAN_MIN_DIRS = 4
+    
+    # 单次列表的条目上限，超出部分以 truncated 节点表示，前端可按子路径再请求
+    MAX_ENTRIES_PER_DIR = 2000
+    MAX_TOTAL_ENTRIES = 20000
+    
+    # 写文件时是否在替换前 fsync，保证断电后内容已落盘（代价是每次写入都要等待磁盘）
+    FSYNC_WRITES = False
+    
+    # 文件预览读取的最大字节数，超出部分截断
+    MAX_PREVIEW_SIZE = 2 * 1024 * 1024
+    
+    # 搜索结果上限，达到后立即停止遍历
+    MAX_SEARCH_RESULTS = 500
+    
     def __init__(self):
         """Initialize the file service"""
         self.downloads = {}  # 存储下载任务信息
         self.download_status = {}  # 存储下载状态
-        self._download_lock = threading.Lock()  # 线程锁，保护下载状态字典
+        self._download_lock = threading.Lock()  # 线程锁，保护下载字典的增加与遍历
+        # 按下载ID分段的锁，单个下载的状态修改只锁对应分段，避免与监控线程争用同一把锁
+        self._download_locks = [threading.Lock() for _ in range(DOWNLOAD_LOCK_STRIPES)]
+        self._dir_cache = {}  # conversation_id -> 已确认存在的会话文件目录
+        self._base_real = {}  # 会话文件目录 -> realpath，用于路径遍历检查
+        self._ensured_dirs = set()  # 本进程中已确保存在的下载目录
+        self._tree_cache = {}  # (conversation_id, path) -> (目录stat标识, 缓存时间, 文件树)
         
         # 启动下载状态监控线程
-        self._monitor_thread = threading.Thread(target=self._monitor_downloads, daemon=True)
+        # 进程结束通过pidfd由事件循环(epoll)通知，进度按自适应间隔检查，没有进行中的下载时不再唤醒
+        self._loop = asyncio.new_event_loop()
+        self._tick_handle = None
+        self._monitor_interval = MONITOR_INTERVAL
+        self._speed_unsettled = False
+        self._monitor_thread = threading.Thread(target=self._run_monitor_loop, daemon=True)
         self._monitor_thread.start()
     
+    def _lock_for(self, download_id: str) -> threading.Lock:
+        """Get the lock stripe guarding a download's state"""
+        return self._download_locks[hash(download_id) % DOWNLOAD_LOCK_STRIPES]
+    
     def get_conversation_files_dir(self, conversation_id: str) -> str:
         """Get the directory for conversation files"""
+        return self._conv_dir(conversation_id, create=True)
+    
+    def _conv_dir(self, conversation_id: str, create: bool = False) -> str:
+        """Get the conversation files directory, creating it only on write paths.
+        
+        The path is cached once it is known to exist so repeated calls skip the filesystem.
+        """
+        cached = self._dir_cache.get(conversation_id)
+        if cached:
+            return cached
+        
         conversation_files_dir = os.path.join(FILES_DIR, conversation_id)
-        os.makedirs(conversation_files_dir, exist_ok=True)
+        if create:
+            os.makedirs(conversation_files_dir, exist_ok=True)
+        elif not os.path.isdir(conversation_files_dir):
+            return conversation_files_dir
+        
+        self._dir_cache[conversation_id] = conversation_files_dir
         return conversation_files_dir
     
+    def _real_base(self, base_dir: str) -> str:
+        """Get the cached realpath of a conversation files directory"""
+        base_real = self._base_real.get(base_dir)
+        if base_real is None:
+            base_real = self._base_real[base_dir] = os.path.realpath(base_dir)
+        return base_real
+    
+    def _safe_join(self, base_real: str, *parts: str) -> str:
+        """Join path parts onto base_real, rejecting paths that resolve outside of it"""
+        # 直接拼接后只做一次normpath，空的part产生的重复分隔符也由normpath处理
+        full_path = os.path.normpath(f"{base_real}{os.sep}{os.sep.join(parts)}")
+        if os.path.commonpath([os.path.realpath(full_path), base_real]) != base_real:
+            raise ValueError("Invalid file path")
+        return full_path
+    
     def get_conversation_downloads_dir(self, conversation_id: str) -> str:
         """获取会话下载目录"""
         conversation_downloads_dir = os.path.join(DOWNLOADS_DIR, conversation_id)
-        os.makedirs(conversation_downloads_dir, exist_ok=True)
+        self._ensure_dir(conversation_downloads_dir)
         return conversation_downloads_dir
     
+    def _ensure_dir(self, directory: str) -> None:
+        """Create a directory once per process; later calls are a set lookup"""
+        if directory not in self._ensured_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._ensured_dirs.add(directory)
+    
     def get_all_files(self, conversation_id: str, path: str = "") -> List[Dict]:
         """Get all files and directories for a conversation"""
-        base_dir = self.get_conversation_files_dir(conversation_id)
+        base_dir = self._conv_dir(conversation_id)
         
         if path:
             target_dir = os.path.join(base_dir, path)
@@ -61,394 +267,494 @@ class FileService:
         else:
             target_dir = base_dir
         
-        if not os.path.exists(target_dir):
+        try:
+            st = os.stat(target_dir)
+        except OSError:
             return []
-            
-        result = []
         
+        cache_key = (conversation_id, path)
+        stamp = (st.st_mtime_ns, st.st_ino)
+        cached = self._tree_cache.get(cache_key)
+        if cached and cached[0] == stamp and time.monotonic() - cached[1] < self.TREE_CACHE_TTL:
+            return cached[2]
+            
         try:
-            for item in os.listdir(target_dir):
-                item_path = os.path.join(target_dir, item)
-                relative_path = os.path.relpath(item_path, base_dir)
-                
-                # Skip hidden files and directories
-                if item.startswith('.'):
-                    continue
-                
-                if os.path.isdir(item_path):
-                    # Handle directory
-                    children = self._get_directory_children(item_path, base_dir)
-                    result.append({
-                        'id': f"dir-{uuid.uuid4().hex[:8]}",
-                        'name': item,
-                        'path': relative_path,
-                        'type': 'folder',
-                        'children': children
-                    })
-                else:
-                    # Handle file
-                    file_type = self._get_file_type(item)
-                    result.append({
-                        'id': f"file-{uuid.uuid4().hex[:8]}",
-                        'name': item,
-                        'path': relative_path,
-                        'type': file_type,
-                        'size': os.path.getsize(item_path)
-                    })
+            tree = self._walk_tree(base_dir, target_dir)
         except Exception as e:
             logger.error(f"Error getting files: {e}")
             return []
         
-        return sorted(result, key=lambda x: (x['type'] != 'folder', x['name']))
+        self._tree_cache[cache_key] = (stamp, time.monotonic(), tree)
+        return tree
     
-    def _get_directory_children(self, directory_path: str, base_dir: str, max_depth: int = 1, current_depth: int = 0) -> List[Dict]:
-        """Get children of a directory up to a certain depth"""
-        if current_depth >= max_depth:
-            return []
-            
+    def _invalidate_tree(self, conversation_id: str) -> None:
+        """Drop cached file trees of a conversation after a write"""
+        for key in list(self._tree_cache):
+            if key[0] == conversation_id:
+                self._tree_cache.pop(key, None)
+    
+    def _walk_tree(self, base_dir: str, target_dir: str, max_depth: int = 1) -> List[Dict]:
+        """Build the file tree of target_dir level by level, descending up to max_depth folder levels"""
+        base_len = len(base_dir) + 1
         result = []
+        level = [(target_dir, result)]
+        total = 0
         
-        try:
-            for item in os.listdir(directory_path):
-                if item.startswith('.'):
+        for depth in range(max_depth + 1):
+            if not level:
+                break
+            
+            # 同一层的子目录相互独立，数量足够多时并发扫描以重叠目录读取的等待
+            if self.PARALLEL_SCAN and len(level) >= self.PARALLEL_SCAN_MIN_DIRS:
+                scans = list(_SCAN_POOL.map(lambda item: self._scan_dir(item[0], base_len, depth), level))
+            else:
+                scans = [self._scan_dir(directory_path, base_len, depth) for directory_path, _ in level]
+            
+            next_level = []
+            for (directory_path, nodes), (entries, skipped) in zip(level, scans):
+                allowed = self.MAX_TOTAL_ENTRIES - total
+                if allowed <= 0:
+                    # 总数已达上限，剩余目录不再展开
+                    nodes.append(self._truncated_node(directory_path[base_len:], None))
                     continue
-                    
-                item_path = os.path.join(directory_path, item)
-                relative_path = os.path.relpath(item_path, base_dir)
+                if len(entries) > allowed:
+                    skipped += len(entries) - allowed
+                    entries = entries[:allowed]
+                total += len(entries)
                 
-                if os.path.isdir(item_path):
-                    children = [] if current_depth >= max_depth - 1 else self._get_directory_children(
-                        item_path, base_dir, max_depth, current_depth + 1
-                    )
-                    result.append({
-                        'id': f"dir-{uuid.uuid4().hex[:8]}",
-                        'name': item,
-                        'path': relative_path,
-                        'type': 'folder',
-                        'children': children
-                    })
-                else:
-                    file_type = self._get_file_type(item)
-                    result.append({
-                        'id': f"file-{uuid.uuid4().hex[:8]}",
-                        'name': item,
-                        'path': relative_path,
-                        'type': file_type
-                    })
+                nodes.extend(entries)
+                if skipped:
+                    nodes.append(self._truncated_node(directory_path[base_len:], skipped))
+                
+                if depth < max_depth:
+                    for node in entries:
+                        if node['type'] == 'folder':
+                            next_level.append((f"{directory_path}{os.sep}{node['name']}", node['children']))
+            level = next_level
+        
+        return result
+    
+    def _scan_dir(self, directory_path: str, base_len: int, depth: int) -> Tuple[List[Dict], int]:
+        """Scan one directory into sorted nodes (folders first), returning them with the count of entries over the cap"""
+        # 插入时即分为目录和文件两组，排序只需按名称比较
+        dirs_buf = []
+        files_buf = []
+        skipped = 0
+        try:
+            with os.scandir(directory_path) as it:
+                for entry in it:
+                    # Skip hidden files and directories
+                    if entry.name.startswith('.'):
+                        continue
+                    
+                    if len(dirs_buf) + len(files_buf) >= self.MAX_ENTRIES_PER_DIR:
+                        # 只计数剩余条目，不再构造节点或stat
+                        skipped = 1 + sum(1 for e in it if not e.name.startswith('.'))
+                        break
+                    
+                    relative_path = entry.path[base_len:]
+                    
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs_buf.append({
+                            'id': _new_id('dir'),
+                            'name': entry.name,
+                            'path': relative_path,
+                            'type': 'folder',
+                            'children': []
+                        })
+                    else:
+                        node = {
+                            'id': _new_id('file'),
+                            'name': entry.name,
+                            'path': relative_path,
+                            'type': self._get_file_type(entry.name)
+                        }
+                        # Only top-level files report their size
+                        if depth == 0:
+                            node['size'] = entry.stat(follow_symlinks=False).st_size
+                        files_buf.append(node)
         except Exception as e:
+            if depth == 0:
+                raise
             logger.error(f"Error getting directory children: {e}")
         
-        return sorted(result, key=lambda x: (x['type'] != 'folder', x['name']))
+        dirs_buf.sort(key=_BY_NAME)
+        files_buf.sort(key=_BY_NAME)
+        dirs_buf.extend(files_buf)
+        return dirs_buf, skipped
+    
+    def _truncated_node(self, relative_dir: str, count: Optional[int]) -> Dict:
+        """Placeholder for entries left out of a listing (count is None when the directory was not scanned)"""
+        return {
+            'id': _new_id('more'),
+            'name': '...',
+            'path': relative_dir,
+            'type': 'truncated',
+            'count': count
+        }
     
     def _get_file_type(self, filename: str) -> str:
         """Determine file type based on extension"""
-        lower_name = filename.lower()
-        
-        # Bioinformatics file types
-        if lower_name.endswith(('.fastq', '.fq', '.fastq.gz', '.fq.gz')):
-            return 'fastq'
-        elif lower_name.endswith(('.fasta', '.fa', '.fna', '.faa', '.fasta.gz', '.fa.gz')):
-            return 'fasta'
-        elif lower_name.endswith(('.sam', '.bam', '.cram')):
-            return 'alignment'
-        elif lower_name.endswith(('.vcf', '.vcf.gz', '.bcf')):
-            return 'variant'
-        elif lower_name.endswith(('.gtf', '.gff', '.gff3')):
-            return 'annotation'
-        elif lower_name.endswith(('.bed', '.bedgraph', '.bigwig', '.bw')):
-            return 'genomic'
-        
-        # Programming languages
-        elif lower_name.endswith('.py'):
-            return 'python'
-        elif lower_name.endswith(('.r', '.rmd')):
-            return 'r'
-        elif lower_name.endswith('.sh'):
-            return 'shell'
-        elif lower_name.endswith(('.pl', '.pm')):
-            return 'perl'
-        
-        # Documents & Data
-        elif lower_name.endswith(('.txt', '.md', '.log')):
-            return 'text'
-        elif lower_name.endswith(('.csv', '.tsv')):
-            return 'tabular'
-        elif lower_name.endswith('.json'):
-            return 'json'
-        elif lower_name.endswith('.xml'):
-            return 'xml'
-        elif lower_name.endswith('.pdf'):
-            return 'pdf'
-        
-        # Default
-        return 'file'
+        m = EXT_PATTERN.search(filename)
+        return EXT_TYPE_MAP[m.group(1).lower()] if m else 'file'
     
     def search_files(self, query: str, conversation_id: str) -> List[Dict]:
         """Search for files by name"""
-        all_files = self.get_all_files(conversation_id)
-        query = query.lower()
+        base_dir = self._conv_dir(conversation_id)
+        if not os.path.isdir(base_dir):
+            return []
         
+        base_len = len(base_dir) + 1
+        query = query.lower()
         result = []
-        self._search_files_recursive(all_files, query, result)
+        stack = [base_dir]
+        
+        # 直接遍历文件系统，只为命中项构造节点，不再先建整棵树
+        while stack and len(result) < self.MAX_SEARCH_RESULTS:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        if entry.name.startswith('.'):
+                            continue
+                        
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        if query in entry.name.lower():
+                            result.append({
+                                'id': _new_id('dir' if is_dir else 'file'),
+                                'name': entry.name,
+                                'path': entry.path[base_len:],
+                                'type': 'folder' if is_dir else self._get_file_type(entry.name)
+                            })
+                            if len(result) >= self.MAX_SEARCH_RESULTS:
+                                break
+                        if is_dir:
+                            stack.append(entry.path)
+            except OSError as e:
+                logger.error(f"Error searching files: {e}")
         
         return result
     
-    def _search_files_recursive(self, files: List[Dict], query: str, result: List[Dict]) -> None:
-        """Recursively search through files and directories"""
-        for file in files:
-            if query in file['name'].lower():
-                result.append(file)
-            
-            if file['type'] == 'folder' and 'children' in file:
-                self._search_files_recursive(file['children'], query, result)
-    
     def create_file(self, name: str, content: str, conversation_id: str, path: str = "") -> Dict:
         """Create a new file"""
-        base_dir = self.get_conversation_files_dir(conversation_id)
-        
-        if path:
-            target_dir = os.path.join(base_dir, path)
-            if not os.path.exists(target_dir):
-                os.makedirs(target_dir, exist_ok=True)
-        else:
-            target_dir = base_dir
-        
-        file_path = os.path.join(target_dir, name)
+        base_dir = self._real_base(self._conv_dir(conversation_id, create=True))
         
         # Prevent path traversal attacks
-        if not os.path.abspath(file_path).startswith(os.path.abspath(base_dir)):
-            raise ValueError("Invalid file path")
+        file_path = self._safe_join(base_dir, path, name)
+        
+        if path:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
         
         # Write file content
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(content)
+        data = content.encode('utf-8')
+        self._atomic_write(file_path, data)
+        
+        self._invalidate_tree(conversation_id)
         
         return {
-            'id': f"file-{uuid.uuid4().hex[:8]}",
+            'id': _new_id('file'),
             'name': name,
-            'path': os.path.relpath(file_path, base_dir),
+            'path': file_path[len(base_dir) + 1:],
             'type': self._get_file_type(name),
-            'size': os.path.getsize(file_path)
+            'size': len(data)
         }
     
     def create_directory(self, name: str, conversation_id: str, path: str = "") -> Dict:
         """Create a new directory"""
-        base_dir = self.get_conversation_files_dir(conversation_id)
-        
-        if path:
-            parent_dir = os.path.join(base_dir, path)
-            if not os.path.exists(parent_dir):
-                os.makedirs(parent_dir, exist_ok=True)
-        else:
-            parent_dir = base_dir
-        
-        dir_path = os.path.join(parent_dir, name)
+        base_dir = self._real_base(self._conv_dir(conversation_id, create=True))
         
         # Prevent path traversal attacks
-        if not os.path.abspath(dir_path).startswith(os.path.abspath(base_dir)):
-            raise ValueError("Invalid directory path")
+        dir_path = self._safe_join(base_dir, path, name)
         
         os.makedirs(dir_path, exist_ok=True)
+        self._invalidate_tree(conversation_id)
         
         return {
-            'id': f"dir-{uuid.uuid4().hex[:8]}",
+            'id': _new_id('dir'),
             'name': name,
-            'path': os.path.relpath(dir_path, base_dir),
+            'path': dir_path[len(base_dir) + 1:],
             'type': 'folder',
             'children': []
         }
     
     def get_file_content(self, file_path: str, conversation_id: str) -> Dict:
         """Get the content of a file"""
-        base_dir = self.get_conversation_files_dir(conversation_id)
-        full_path = os.path.join(base_dir, file_path)
+        base_dir = self._real_base(self._conv_dir(conversation_id))
         
         # Prevent path traversal attacks
-        if not os.path.abspath(full_path).startswith(os.path.abspath(base_dir)):
-            raise ValueError("Invalid file path")
+        full_path = self._safe_join(base_dir, file_path)
         
-        if not os.path.exists(full_path) or os.path.isdir(full_path):
+        if not os.path.isfile(full_path):
             raise FileNotFoundError(f"File not found: {file_path}")
         
         # Check if it's a binary file
-        mime_type, _ = mimetypes.guess_type(full_path)
-        is_binary = mime_type and not mime_type.startswith(('text/', 'application/json'))
+        file_type = self._get_file_type(full_path)
+        if file_type in _TEXT_TYPES:
+            is_binary = False
+        elif file_type in _BINARY_TYPES:
+            is_binary = True
+        else:
+            mime_type, _ = mimetypes.guess_type(full_path)
+            is_binary = bool(mime_type) and not mime_type.startswith(('text/', 'application/json'))
         
-        if is_binary:
+        # 只打开一次，大小取自已打开的fd，二进制文件不读内容，大文件只读前 MAX_PREVIEW_SIZE 字节
+        with open(full_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            raw = b'' if is_binary else f.read(min(size, self.MAX_PREVIEW_SIZE))
+        
+        # 扩展名未标为二进制时再嗅探开头4KB是否含空字节（如压缩的 fastq.gz）
+        if is_binary or b'\x00' in raw[:4096]:
             return {
                 'name': os.path.basename(full_path),
                 'path': file_path,
-                'type': self._get_file_type(full_path),
-                'size': os.path.getsize(full_path),
+                'type': file_type,
+                'size': size,
                 'content': "[Binary file content not displayed]",
                 'is_binary': True
             }
         
-        # Read text file content
-        try:
-            with open(full_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-        except UnicodeDecodeError:
-            # If UTF-8 fails, try with Latin-1 encoding
-            with open(full_path, 'r', encoding='latin-1') as f:
-                content = f.read()
+        # Decode text file content, replacing invalid UTF-8 bytes instead of decoding twice
+        content = raw.decode('utf-8', errors='replace')
+        # 保持与文本模式读取一致的换行处理
+        if '\r' in content:
+            content = content.replace('\r\n', '\n').replace('\r', '\n')
         
         return {
             'name': os.path.basename(full_path),
             'path': file_path,
-            'type': self._get_file_type(full_path),
-            'size': os.path.getsize(full_path),
+            'type': file_type,
+            'size': size,
             'content': content,
-            'is_binary': False
+            'is_binary': False,
+            'truncated': size > len(raw)
         }
     
+    def _atomic_write(self, file_path: str, data: bytes, keep_mode: bool = False) -> None:
+        """Write data to a temp file next to file_path and swap it in, so a crash never leaves a partial file"""
+        # 临时文件名带随机后缀，并发写同一文件时互不覆盖；以 . 开头，文件列表中不可见
+        tmp_path = os.path.join(
+            os.path.dirname(file_path),
+            f".{os.path.basename(file_path)}.tmp.{os.urandom(4).hex()}"
+        )
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                if self.FSYNC_WRITES:
+                    f.flush()
+                    os.fsync(f.fileno())
+            if keep_mode:
+                shutil.copymode(file_path, tmp_path)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+    
     def update_file_content(self, file_path: str, content: str, conversation_id: str) -> Dict:
         """Update the content of a file"""
-        base_dir = self.get_conversation_files_dir(conversation_id)
-        full_path = os.path.join(base_dir, file_path)
+        base_dir = self._real_base(self._conv_dir(conversation_id))
         
         # Prevent path traversal attacks
-        if not os.path.abspath(full_path).startswith(os.path.abspath(base_dir)):
-            raise ValueError("Invalid file path")
+        full_path = self._safe_join(base_dir, file_path)
         
-        if not os.path.exists(full_path) or os.path.isdir(full_path):
+        if not os.path.isfile(full_path):
             raise FileNotFoundError(f"File not found: {file_path}")
         
         # Write updated content
-        with open(full_path, 'w', encoding='utf-8') as f:
-            f.write(content)
+        data = content.encode('utf-8')
+        self._atomic_write(full_path, data, keep_mode=True)
+        
+        self._invalidate_tree(conversation_id)
         
         return {
             'name': os.path.basename(full_path),
             'path': file_path,
             'type': self._get_file_type(full_path),
-            'size': os.path.getsize(full_path)
+            'size': len(data)
         }
     
     def delete_file(self, file_path: str, conversation_id: str) -> bool:
         """Delete a file or directory"""
-        base_dir = self.get_conversation_files_dir(conversation_id)
-        full_path = os.path.join(base_dir, file_path)
+        base_dir = self._real_base(self._conv_dir(conversation_id))
         
         # Prevent path traversal attacks
-        if not os.path.abspath(full_path).startswith(os.path.abspath(base_dir)):
-            raise ValueError("Invalid file path")
+        full_path = self._safe_join(base_dir, file_path)
         
-        if not os.path.exists(full_path):
+        # 一次 lstat 同时判断存在与类型；符号链接只删除链接本身
+        try:
+            st = os.lstat(full_path)
+        except FileNotFoundError:
             return False
         
-        if os.path.isdir(full_path):
+        if stat.S_ISDIR(st.st_mode):
             shutil.rmtree(full_path)
         else:
             os.remove(full_path)
             
+        self._invalidate_tree(conversation_id)
         return True
     
     def rename_file(self, old_path: str, new_name: str, conversation_id: str) -> Dict:
         """重命名文件或目录"""
-        base_dir = self.get_conversation_files_dir(conversation_id)
-        full_old_path = os.path.join(base_dir, old_path)
+        base_dir = self._real_base(self._conv_dir(conversation_id))
         
-        # 防止路径遍历攻击
-        if not os.path.abspath(full_old_path).startswith(os.path.abspath(base_dir)):
-            raise ValueError("无效的文件路径")
+        # 防止路径遍历攻击（新名称同样需要检查）
+        full_old_path = self._safe_join(base_dir, old_path)
+        full_new_path = self._safe_join(base_dir, os.path.dirname(old_path), new_name)
         
         if not os.path.exists(full_old_path):
             raise FileNotFoundError(f"文件不存在: {old_path}")
         
-        # 获取目录和文件名
-        old_dir = os.path.dirname(full_old_path)
-        full_new_path = os.path.join(old_dir, new_name)
-        
         # 检查目标文件是否已存在
         if os.path.exists(full_new_path):
             raise ValueError(f"已存在同名文件或目录: {new_name}")
         
         # 执行重命名
         os.rename(full_old_path, full_new_path)
+        self._invalidate_tree(conversation_id)
         
         # 计算相对路径
         new_path = os.path.join(os.path.dirname(old_path), new_name) if os.path.dirname(old_path) else new_name
         
         # 返回文件信息
+        is_dir, size = self._entry_info(full_new_path)
         return {
-            'id': f"{'dir' if os.path.isdir(full_new_path) else 'file'}-{uuid.uuid4().hex[:8]}",
+            'id': _new_id('dir' if is_dir else 'file'),
             'name': new_name,
             'path': new_path,
-            'type': 'folder' if os.path.isdir(full_new_path) else self._get_file_type(new_name),
-            'size': None if os.path.isdir(full_new_path) else os.path.getsize(full_new_path)
+            'type': 'folder' if is_dir else self._get_file_type(new_name),
+            'size': None if is_dir else size
         }
     
+    def _entry_info(self, path: str) -> Tuple[bool, int]:
+        """Return (is_dir, size) of a path from a single lstat"""
+        st = os.lstat(path)
+        return stat.S_ISDIR(st.st_mode), st.st_size
+    
     def get_file_for_download(self, file_path: str, conversation_id: str) -> str:
         """获取文件的完整路径用于下载"""
-        base_dir = self.get_conversation_files_dir(conversation_id)
-        full_path = os.path.join(base_dir, file_path)
+        base_dir = self._real_base(self._conv_dir(conversation_id))
         
         # 防止路径遍历攻击
-        if not os.path.abspath(full_path).startswith(os.path.abspath(base_dir)):
-            raise ValueError("无效的文件路径")
+        full_path = self._safe_join(base_dir, file_path)
         
-        if not os.path.exists(full_path) or os.path.isdir(full_path):
+        if not os.path.isfile(full_path):
             raise FileNotFoundError(f"文件不存在: {file_path}")
         
         return full_path
     
-    def create_zip_for_files(self, file_paths: List[str], conversation_id: str) -> io.BytesIO:
-        """为指定的文件路径列表创建一个临时的ZIP文件流"""
-        base_dir = self.get_conversation_files_dir(conversation_id)
-        memory_file = io.BytesIO()
+    def create_zip_for_files(self, file_paths: List[str], conversation_id: str) -> Iterator[bytes]:
+        """为指定的文件路径列表生成ZIP数据流，按块产出而不在内存中保存整个压缩包"""
+        # 会话目录的真实路径在循环外只解析一次
+        base_dir = self._real_base(self._conv_dir(conversation_id))
+        base_len = len(base_dir) + 1
+        members = []  # (完整路径, zip内相对路径)
 
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for file_path in file_paths:
-                full_path = os.path.join(base_dir, file_path)
-                # 安全性检查：确保文件在会话目录内且存在
-                if not os.path.abspath(full_path).startswith(os.path.abspath(base_dir)):
-                    logger.warning(f"Skipping invalid path for zipping: {file_path}")
-                    continue
-                if not os.path.exists(full_path):
-                    logger.warning(f"Skipping non-existent file for zipping: {file_path}")
-                    continue
-                
-                if os.path.isfile(full_path):
-                    # arcname 参数用于指定文件在zip包中的路径，这里使用相对路径
-                    zf.write(full_path, arcname=file_path)
-                elif os.path.isdir(full_path):
-                    # 如果是目录，则递归添加目录内容
-                    for root, _, files in os.walk(full_path):
-                        for file in files:
-                            actual_file_path = os.path.join(root, file)
-                            # 计算在zip中的相对路径
-                            zip_path = os.path.relpath(actual_file_path, base_dir)
-                            zf.write(actual_file_path, arcname=zip_path)
-        
-        memory_file.seek(0)
-        return memory_file
+        for file_path in file_paths:
+            # 安全性检查：确保文件在会话目录内且存在
+            try:
+                full_path = self._safe_join(base_dir, file_path)
+            except ValueError:
+                logger.warning(f"Skipping invalid path for zipping: {file_path}")
+                continue
+            if not os.path.exists(full_path):
+                logger.warning(f"Skipping non-existent file for zipping: {file_path}")
+                continue
+            
+            if os.path.isfile(full_path):
+                # zip内路径使用请求中的相对路径
+                members.append((full_path, file_path))
+            elif os.path.isdir(full_path):
+                # 如果是目录，则用scandir递归添加目录内容，zip内路径直接由完整路径切片得到
+                stack = [full_path]
+                while stack:
+                    with os.scandir(stack.pop()) as it:
+                        for entry in it:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                            elif entry.is_file():
+                                members.append((entry.path, entry.path[base_len:]))
+        
+        return self._stream_zip(members)
+    
+    def _stream_zip(self, members: List[Tuple[str, str]]) -> Iterator[bytes]:
+        """Write members into a zip archive, yielding the output as it is produced"""
+        sink = _ZipStreamSink()
+        try:
+            with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESS_LEVEL) as zf:
+                for full_path, arcname in members:
+                    # 在写入成员头之前打开源文件，打不开（权限、已被删除）时跳过该文件，压缩包仍然完整
+                    try:
+                        src = open(full_path, 'rb')
+                    except OSError as e:
+                        logger.warning(f"Skipping unreadable file for zipping: {arcname}: {e}")
+                        continue
+                    try:
+                        zinfo = zipfile.ZipInfo.from_file(full_path, arcname)
+                    except OSError as e:
+                        src.close()
+                        logger.warning(f"Skipping unreadable file for zipping: {arcname}: {e}")
+                        continue
+                    
+                    # 已压缩的格式再次deflate几乎不会变小，直接存储；其余使用最快的压缩级别
+                    if arcname.lower().endswith(COMPRESSED_EXTENSIONS):
+                        zinfo.compress_type = zipfile.ZIP_STORED
+                    else:
+                        zinfo.compress_type = zipfile.ZIP_DEFLATED
+                        setattr(zinfo, _ZIPINFO_LEVEL_ATTR, ZIP_COMPRESS_LEVEL)
+                    
+                    with src, zf.open(zinfo, 'w') as dst:
+                        while chunk := src.read(ZIP_CHUNK_SIZE):
+                            dst.write(chunk)
+                            yield from sink.drain()
+                    yield from sink.drain()
+            yield from sink.drain()
+        except Exception:
+            # 响应已经开始发送，无法再返回错误状态；记录下来，避免不完整的压缩包被当作成功
+            logger.exception("Zip stream aborted, the client received a truncated archive")
+            raise
 
     def upload_file(self, file_obj, filename: str, conversation_id: str, path: str = "") -> Dict:
         """Upload a file"""
-        base_dir = self.get_conversation_files_dir(conversation_id)
+        base_dir = self._real_base(self._conv_dir(conversation_id, create=True))
+        
+        # Prevent path traversal attacks
+        file_path = self._safe_join(base_dir, path, filename)
         
         if path:
-            target_dir = os.path.join(base_dir, path)
-            if not os.path.exists(target_dir):
-                os.makedirs(target_dir, exist_ok=True)
-        else:
-            target_dir = base_dir
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
         
-        file_path = os.path.join(target_dir, filename)
+        stream = file_obj.stream
+        src_fd = _stream_fileno(stream)
         
-        # Prevent path traversal attacks
-        if not os.path.abspath(file_path).startswith(os.path.abspath(base_dir)):
-            raise ValueError("Invalid file path")
+        with open(file_path, 'wb') as dst:
+            if src_fd is not None and hasattr(os, 'sendfile'):
+                # 上传已落盘为临时文件时，用sendfile在内核中直接拷贝
+                offset = stream.tell()
+                end = os.fstat(src_fd).st_size
+                dst_fd = dst.fileno()
+                while offset < end:
+                    sent = os.sendfile(dst_fd, src_fd, offset, end - offset)
+                    if not sent:
+                        break
+                    offset += sent
+                size = offset - stream.tell()
+            else:
+                # 分块流式写入，边写边累计大小，避免写完再stat
+                size = 0
+                while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+                    dst.write(chunk)
+                    size += len(chunk)
         
-        file_obj.save(file_path)
+        self._invalidate_tree(conversation_id)
         
         return {
-            'id': f"file-{uuid.uuid4().hex[:8]}",
+            'id': _new_id('file'),
             'name': filename,
-            'path': os.path.relpath(file_path, base_dir),
+            'path': file_path[len(base_dir) + 1:],
             'type': self._get_file_type(filename),
-            'size': os.path.getsize(file_path)
+            'size': size
         }
     
     def download_file(self, url: str, conversation_id: str, filename: str = None, path: str = "") -> Dict:
@@ -458,8 +764,7 @@ class FileService:
         
         if path:
             target_dir = os.path.join(downloads_dir, path)
-            if not os.path.exists(target_dir):
-                os.makedirs(target_dir, exist_ok=True)
+            self._ensure_dir(target_dir)
         else:
             target_dir = downloads_dir
             
@@ -467,25 +772,13 @@ class FileService:
         if not filename:
             filename = url.split('/')[-1]
             if not filename:
-                filename = f"download_{uuid.uuid4().hex[:8]}"
+                filename = f"download_{_ID_EPOCH}{next(_ID_COUNTER):04x}"
         
         # 生成下载ID和状态记录
-        download_id = f"dl-{uuid.uuid4().hex[:8]}"
+        download_id = f"dl-{_ID_EPOCH}-{next(_ID_COUNTER):x}"
         
         # 使用aria2c下载文件
         try:
-            # 创建aria2c命令
-            cmd = [
-                "aria2c", url,
-                "--dir", target_dir,
-                "--out", filename,
-                "--file-allocation=none",
-                "--max-connection-per-server=5",
-                "--max-tries=5",
-                "--retry-wait=5",
-                "--connect-timeout=60"
-            ]
-            
             # 记录下载信息
             download_info = {
                 'id': download_id,
@@ -498,18 +791,22 @@ class FileService:
                 'status': 'downloading',
                 'progress': 0,
                 'start_time': time.time(),
-                'process': None
+                'process': None,
+                'gid': None,
+                'log_path': os.path.join(target_dir, f".{filename}.aria2c.log")
             }
             
-            # 启动下载进程
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            
-            download_info['process'] = process
+            if ARIA2_RPC_URL:
+                # 交给常驻的aria2c守护进程下载，无需每个任务fork一个进程
+                download_info['gid'] = self._aria2_call(
+                    'aria2.addUri', [url], dict(ARIA2_OPTIONS, dir=target_dir, out=filename)
+                )
+            else:
+                # 启动下载进程
+                cmd = ["aria2c", url, "--dir", target_dir, "--out", filename]
+                cmd += [f"--{key}={value}" for key, value in ARIA2_OPTIONS.items()]
+                download_info['process'] = self._spawn_aria2c(cmd, download_info['log_path'])
+                self._watch_process(download_info['process'])
             
             # 保存下载信息
             with self._download_lock:
@@ -529,6 +826,7 @@ class FileService:
                     'start_time': int(time.time() * 1000)
                 }
             
+            self._wake_monitor()  # 唤醒监控循环立即处理
             return self.download_status[download_id]
             
         except Exception as e:
@@ -537,12 +835,12 @@ class FileService:
     
     def get_download_status(self, download_id: str = None, conversation_id: str = None) -> List[Dict]:
         """获取下载状态"""
+        # 如果提供了下载ID，返回特定下载的状态；状态条目整体替换发布，单键读取无需加锁
+        if download_id:
+            status = self.download_status.get(download_id)
+            return [status] if status else []
+        
         with self._download_lock:
-            # 如果提供了下载ID，返回特定下载的状态
-            if download_id:
-                status = self.download_status.get(download_id)
-                return [status] if status else []
-            
             # 如果提供了会话ID，返回该会话的所有下载状态
             if conversation_id:
                 return [
@@ -555,13 +853,20 @@ class FileService:
     
     def cancel_download(self, download_id: str) -> bool:
         """取消下载任务"""
-        with self._download_lock:
+        with self._lock_for(download_id):
             if download_id not in self.downloads:
                 return False
             
             download_info = self.downloads[download_id]
             process = download_info.get('process')
             
+            if download_info.get('gid'):
+                try:
+                    self._aria2_call('aria2.remove', download_info['gid'])
+                except Exception as e:
+                    # 任务可能已经结束，aria2会返回错误
+                    logger.debug(f"aria2 remove {download_info['gid']} 失败: {e}")
+            
             # 终止进程
             if process and process.poll() is None:
                 process.terminate()
@@ -570,16 +875,21 @@ class FileService:
                 except subprocess.TimeoutExpired:
                     process.kill()
             
+            if process:
+                try:
+                    os.remove(download_info['log_path'])
+                except OSError:
+                    pass
+            
             # 更新状态
-            download_info['status'] = 'cancelled'
-            if download_id in self.download_status:
-                self.download_status[download_id]['status'] = 'cancelled'
+            self._publish_locked(download_id, download_info, status='cancelled')
             
+            self._wake_monitor()  # 唤醒监控循环立即处理
             return True
     
     def pause_download(self, download_id: str) -> bool:
         """暂停下载任务"""
-        with self._download_lock:
+        with self._lock_for(download_id):
             if download_id not in self.downloads:
                 logger.warning(f"暂停失败: 下载ID {download_id} 不存在")
                 return False
@@ -587,6 +897,19 @@ class FileService:
             download_info = self.downloads[download_id]
             process = download_info.get('process')
             
+            if download_info.get('gid'):
+                if download_info['status'] != 'downloading':
+                    logger.warning(f"无法暂停下载 {download_id}: 状态为 {download_info['status']}")
+                    return False
+                try:
+                    self._aria2_call('aria2.pause', download_info['gid'])
+                except Exception as e:
+                    logger.error(f"暂停下载时出错: {e}")
+                    return False
+                download_info['paused_at'] = time.time()
+                self._publish_locked(download_id, download_info, status='paused')
+                return True
+            
             # 如果进程正在运行，发送暂停信号
             if process and process.poll() is None:
                 try:
@@ -602,12 +925,9 @@ class FileService:
                             process.kill()
                     
                     # 更新状态
-                    download_info['status'] = 'paused'
                     download_info['paused_at'] = time.time()
                     download_info['paused_size'] = download_info.get('downloaded_size', 0)
-                    
-                    if download_id in self.download_status:
-                        self.download_status[download_id]['status'] = 'paused'
+                    self._publish_locked(download_id, download_info, status='paused')
                     
                     logger.info(f"下载 {download_id} 已暂停，当前大小: {download_info.get('downloaded_size', 0)} 字节")
                     return True
@@ -620,7 +940,7 @@ class FileService:
     
     def resume_download(self, download_id: str) -> bool:
         """恢复已暂停的下载任务"""
-        with self._download_lock:
+        with self._lock_for(download_id):
             if download_id not in self.downloads:
                 logger.warning(f"恢复失败: 下载ID {download_id} 不存在")
                 return False
@@ -632,8 +952,10 @@ class FileService:
                 return False
             
             try:
-                # 根据操作系统选择恢复方法
-                if os.name == 'posix' and download_info.get('process') and download_info['process'].poll() is None:
+                # 根据下载方式选择恢复方法
+                if download_info.get('gid'):
+                    self._aria2_call('aria2.unpause', download_info['gid'])
+                elif os.name == 'posix' and download_info.get('process') and download_info['process'].poll() is None:
                     # Unix系统: 发送继续信号
                     os.kill(download_info['process'].pid, signal.SIGCONT)
                     logger.info(f"已发送SIGCONT信号恢复下载 {download_id}")
@@ -648,202 +970,326 @@ class FileService:
                     path = os.path.dirname(download_info['path']) if '/' in download_info['path'] else ''
                     
                     # 创建aria2c命令，尝试断点续传
-                    cmd = [
-                        "aria2c", url,
-                        "--dir", target_dir,
-                        "--out", filename,
-                        "--file-allocation=none",
-                        "--max-connection-per-server=5",
-                        "--max-tries=5",
-                        "--retry-wait=5",
-                        "--connect-timeout=60",
-                        "--continue=true"  # 启用断点续传
-                    ]
+                    cmd = ["aria2c", url, "--dir", target_dir, "--out", filename]
+                    cmd += [f"--{key}={value}" for key, value in ARIA2_OPTIONS.items()]
+                    cmd.append("--continue=true")  # 启用断点续传
                     
                     # 启动新进程
-                    process = subprocess.Popen(
-                        cmd,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True
-                    )
+                    process = self._spawn_aria2c(cmd, download_info['log_path'])
+                    self._watch_process(process)
                     
                     # 更新下载信息
                     download_info['process'] = process
                     logger.info(f"已重新启动下载进程 {download_id}")
                 
                 # 更新状态
-                download_info['status'] = 'downloading'
                 download_info['resumed_at'] = time.time()
+                self._publish_locked(download_id, download_info, status='downloading')
                 
-                if download_id in self.download_status:
-                    self.download_status[download_id]['status'] = 'downloading'
-                
+                self._wake_monitor()  # 唤醒监控循环立即处理
                 return True
             except Exception as e:
                 logger.error(f"恢复下载时出错: {e}")
                 return False
 
-    def _monitor_downloads(self):
-        """监控下载进度和状态"""
-        while True:
-            try:
-                # 获取当前所有下载的副本
-                with self._download_lock:
-                    downloads = self.downloads.copy()
+    def _run_monitor_loop(self) -> None:
+        """Run the download monitor event loop (background thread)"""
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+    
+    def _wake_monitor(self) -> None:
+        """Ask the monitor loop to check downloads now (thread-safe)"""
+        self._loop.call_soon_threadsafe(self._monitor_tick)
+    
+    def _monitor_tick(self) -> None:
+        """Check downloads once, scheduling the next check only while some are still running"""
+        if self._tick_handle is not None:
+            self._tick_handle.cancel()
+            self._tick_handle = None
+        self._speed_unsettled = False
+        if self._check_downloads():
+            if self._speed_unsettled:
+                self._monitor_interval = MONITOR_INTERVAL_MIN
+            else:
+                self._monitor_interval = min(self._monitor_interval * 1.5, MONITOR_INTERVAL_MAX)
+            self._tick_handle = self._loop.call_later(self._monitor_interval, self._monitor_tick)
+        else:
+            self._monitor_interval = MONITOR_INTERVAL
+    
+    def _note_speed(self, old_speed: float, speed: float) -> None:
+        """Record whether a download's speed is still changing, which shortens the next check interval"""
+        if abs(speed - old_speed) > MONITOR_SETTLE_RATIO * max(old_speed, 1):
+            self._speed_unsettled = True
+    
+    def _watch_process(self, process: subprocess.Popen) -> None:
+        """Have the monitor loop notified through a pidfd as soon as a download process exits"""
+        if not hasattr(os, 'pidfd_open'):
+            return  # 不支持pidfd时由周期检查发现进程结束
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except OSError:
+            return
+        self._loop.call_soon_threadsafe(self._loop.add_reader, pidfd, self._on_process_exit, pidfd)
+    
+    def _on_process_exit(self, pidfd: int) -> None:
+        """pidfd became readable: the process exited, check downloads right away"""
+        self._loop.remove_reader(pidfd)
+        os.close(pidfd)
+        self._monitor_tick()
+    
+    def _check_downloads(self) -> bool:
+        """监控下载进度和状态，返回是否仍有进行中的下载"""
+        try:
+            # 只在锁内收集进行中的下载，不复制整个字典
+            with self._download_lock:
+                active = [
+                    (download_id, download_info)
+                    for download_id, download_info in self.downloads.items()
+                    if download_info['status'] == 'downloading'
+                ]
+            
+            # 本轮检查共用一个单调时间戳，速度计算不受系统时钟调整影响
+            now = time.monotonic()
+            # 循环内反复使用的属性/函数先绑定为局部变量
+            stat = os.stat
+            publish = self._publish
+            note_speed = self._note_speed
+            debug = logger.isEnabledFor(logging.DEBUG)
+            for download_id, download_info in active:
+                # 收集之后可能已被取消或暂停
+                if download_info['status'] != 'downloading':
+                    continue
                 
-                for download_id, download_info in downloads.items():
-                    # 跳过已完成、失败或取消的下载
-                    if download_info['status'] in ['completed', 'failed', 'cancelled']:
-                        continue
-                    
-                    # 跳过已暂停的下载
-                    if download_info['status'] == 'paused':
-                        continue
-                    
-                    process = download_info.get('process')
-                    
-                    # 如果进程不存在，标记为失败
-                    if not process:
-                        with self._download_lock:
-                            download_info['status'] = 'failed'
-                            if download_id in self.download_status:
-                                self.download_status[download_id]['status'] = 'failed'
-                        continue
+                if download_info.get('gid'):
+                    self._poll_aria2_download(download_id, download_info)
+                    continue
+                
+                process = download_info.get('process')
+                
+                # 如果进程不存在，标记为失败
+                if not process:
+                    self._set_download_status(download_id, download_info, 'failed', expect='downloading')
+                    continue
+                
+                # 检查进程是否已结束
+                if process.poll() is not None:
+                    try:
+                        os.remove(download_info['log_path'])
+                    except OSError:
+                        pass
                     
-                    # 检查进程是否已结束
-                    if process.poll() is not None:
-                        # 进程已结束，检查是否成功
-                        if process.returncode == 0:
-                            # 下载成功，移动文件到会话目录
-                            target_path = download_info['target_path']
-                            if os.path.exists(target_path):
-                                # 获取文件大小
-                                file_size = os.path.getsize(target_path)
-                                
-                                # 成功下载，更新状态
-                                with self._download_lock:
-                                    download_info['status'] = 'completed'
-                                    download_info['progress'] = 100
-                                    download_info['size'] = file_size
-                                    download_info['downloaded_size'] = file_size
-                                    download_info['speed'] = 0  # 下载完成，速度为0
-                                    download_info['eta'] = 0    # 下载完成，剩余时间为0
-                                    
-                                    if download_id in self.download_status:
-                                        self.download_status[download_id]['status'] = 'completed'
-                                        self.download_status[download_id]['progress'] = 100
-                                        self.download_status[download_id]['size'] = file_size
-                                        self.download_status[download_id]['downloaded_size'] = file_size
-                                        self.download_status[download_id]['speed'] = 0
-                                        self.download_status[download_id]['eta'] = 0
-                                
-                                # 移动到用户文件目录
-                                dest_path = os.path.join(
-                                    self.get_conversation_files_dir(download_info['conversation_id']),
-                                    os.path.basename(target_path)
-                                )
-                                try:
-                                    shutil.copy2(target_path, dest_path)
-                                except Exception as e:
-                                    logger.error(f"移动下载文件错误: {e}")
-                            else:
-                                # 文件不存在，下载失败
-                                with self._download_lock:
-                                    download_info['status'] = 'failed'
-                                    if download_id in self.download_status:
-                                        self.download_status[download_id]['status'] = 'failed'
-                        else:
-                            # 下载失败
-                            with self._download_lock:
-                                download_info['status'] = 'failed'
-                                if download_id in self.download_status:
-                                    self.download_status[download_id]['status'] = 'failed'
-                    else:
-                        # 进程仍在运行，检查进度
+                    # 进程已结束，检查是否成功
+                    if process.returncode == 0:
+                        # 下载成功，移动文件到会话目录
                         target_path = download_info['target_path']
                         if os.path.exists(target_path):
-                            try:
-                                # 获取文件大小作为进度指示
-                                current_size = os.path.getsize(target_path)
-                                
-                                # 获取文件总大小 (如果未知)
-                                if 'size' not in download_info or download_info.get('size', 0) <= 0:
-                                    try:
-                                        # 读取一行aria2c输出，尝试获取文件总大小
-                                        output = process.stdout.readline().strip() if process.stdout else ""
-                                        if output and "Total Length:" in output:
-                                            size_part = output.split("Total Length:")[1].strip()
-                                            if "(" in size_part:
-                                                size_bytes = size_part.split("(")[1].split(")")[0].strip()
-                                                if "bytes" in size_bytes:
-                                                    try:
-                                                        total_size = int(size_bytes.replace("bytes", "").strip())
-                                                        download_info['size'] = total_size
-                                                        if download_id in self.download_status:
-                                                            self.download_status[download_id]['size'] = total_size
-                                                    except ValueError:
-                                                        pass
-                                    except Exception as e:
-                                        logger.debug(f"读取aria2c输出时出错: {e}")
-                                
-                                # 计算下载速度
-                                now = time.time()
-                                last_check_time = download_info.get('last_check_time', now - 2)
-                                last_size = download_info.get('last_size', 0)
-                                
-                                time_diff = max(now - last_check_time, 0.1)  # 避免除以零
-                                size_diff = max(current_size - last_size, 0)  # 避免负值
-                                
-                                # 计算平滑的速度 (使用指数移动平均)
-                                old_speed = download_info.get('speed', 0)
-                                new_instantaneous_speed = size_diff / time_diff
-                                alpha = 0.3  # 平滑因子
-                                speed = alpha * new_instantaneous_speed + (1 - alpha) * old_speed
-                                
-                                # 避免速度为0
-                                if speed < 100 and new_instantaneous_speed > 0:
-                                    speed = new_instantaneous_speed
-                                
-                                # 更新最后检查时间和大小
-                                download_info['last_check_time'] = now
-                                download_info['last_size'] = current_size
-                                
-                                # 计算ETA (预计剩余时间)
-                                eta = 0
-                                if speed > 100:  # 确保至少有一些有意义的速度
-                                    total_size = download_info.get('size', 0)
-                                    if total_size > current_size:
-                                        remaining_bytes = total_size - current_size
-                                        eta = remaining_bytes / speed  # 秒
-                                
-                                # 确保进度百分比有意义
-                                total_size = download_info.get('size', 0)
-                                if total_size > 0:
-                                    progress = min(int((current_size / total_size) * 100), 99)
-                                else:
-                                    # 如果不知道总大小，使用估算值
-                                    progress = min(max(1, int(current_size / (1024 * 1024))), 99)  # 每MB大约1%进度
-                                
+                            self._complete_download(download_id, download_info)
+                        else:
+                            # 文件不存在，下载失败
+                            self._set_download_status(download_id, download_info, 'failed', expect='downloading')
+                    else:
+                        # 下载失败
+                        self._set_download_status(download_id, download_info, 'failed', expect='downloading')
+                else:
+                    # 进程仍在运行，检查进度
+                    target_path = download_info['target_path']
+                    try:
+                        # 一次stat同时判断文件是否存在并获取大小作为进度指示
+                        current_size = stat(target_path).st_size
+                    except OSError:
+                        current_size = None
+                    if current_size is not None:
+                        try:
+                            # 获取文件总大小 (如果未知)
+                            if 'size' not in download_info or download_info.get('size', 0) <= 0:
+                                # 从aria2c日志末尾解析文件总大小，不会阻塞监控线程
+                                total_size = self._read_total_length(download_info['log_path'])
+                                if total_size:
+                                    publish(download_id, download_info, expect='downloading', size=total_size)
+                            
+                            # 计算下载速度
+                            last_check_time = download_info.get('last_check_time', now - 2)
+                            last_size = download_info.get('last_size', 0)
+                            
+                            time_diff = max(now - last_check_time, 0.1)  # 避免除以零
+                            size_diff = max(current_size - last_size, 0)  # 避免负值
+                            
+                            # 计算平滑的速度 (使用指数移动平均)
+                            old_speed = download_info.get('speed', 0)
+                            new_instantaneous_speed = size_diff / time_diff
+                            speed = SPEED_EMA_ALPHA * new_instantaneous_speed + SPEED_EMA_KEEP * old_speed
+                            
+                            # 避免速度为0
+                            if speed < 100 and new_instantaneous_speed > 0:
+                                speed = new_instantaneous_speed
+                            
+                            # 更新最后检查时间和大小
+                            download_info['last_check_time'] = now
+                            download_info['last_size'] = current_size
+                            
+                            # 计算ETA (预计剩余时间)
+                            total_size = download_info.get('size', 0)
+                            eta = 0
+                            if speed > 100 and total_size > current_size:  # 确保至少有一些有意义的速度
+                                eta = (total_size - current_size) / speed  # 秒
+                            
+                            # 确保进度百分比有意义
+                            if total_size > 0:
+                                progress = min(int((current_size / total_size) * 100), 99)
+                            else:
+                                # 如果不知道总大小，使用估算值
+                                progress = min(max(1, int(current_size / (1024 * 1024))), 99)  # 每MB大约1%进度
+                            
+                            # EMA状态只由监控线程读写，无需加锁
+                            download_info['speed'] = speed
+                            note_speed(old_speed, speed)
+                            
+                            # 只有对外可见的值变化时才加锁写回，停滞的下载不再每次检查都写字典
+                            snapshot = (progress, current_size, int(speed), int(eta))
+                            if snapshot == download_info.get('published'):
+                                continue
+                            download_info['published'] = snapshot
+                            
+                            if debug:
+                                # 未开启DEBUG时不格式化日志字符串
                                 logger.debug(f"下载 {download_id}: 大小={current_size}/{total_size}, 速度={speed:.2f} B/s, ETA={eta:.2f}s, 进度={progress}%")
-                                
-                                # 更新进度和其他信息
-                                with self._download_lock:
-                                    download_info['progress'] = progress
-                                    download_info['downloaded_size'] = current_size
-                                    download_info['speed'] = speed
-                                    download_info['eta'] = eta
-                                    
-                                    if download_id in self.download_status:
-                                        self.download_status[download_id]['progress'] = progress
-                                        self.download_status[download_id]['downloaded_size'] = current_size
-                                        self.download_status[download_id]['speed'] = speed
-                                        self.download_status[download_id]['eta'] = eta
-                            except Exception as e:
-                                logger.error(f"获取下载进度错误: {e}")
-                
-            except Exception as e:
-                logger.error(f"监控下载错误: {e}")
+                            
+                            # 更新进度和其他信息
+                            publish(download_id, download_info, expect='downloading', progress=progress,
+                                    downloaded_size=current_size, speed=speed, eta=eta)
+                        except Exception as e:
+                            logger.error(f"获取下载进度错误: {e}")
             
-            # 降低检查频率以减少CPU使用率
-            time.sleep(1)
\ No newline at end of file
+        except Exception as e:
+            logger.error(f"监控下载错误: {e}")
+            return True
+        
+        return any(download_info['status'] == 'downloading' for _, download_info in active)
+
+    def _spawn_aria2c(self, cmd: List[str], log_path: str) -> subprocess.Popen:
+        """Start aria2c with its console output going to a log file instead of a pipe nobody drains"""
+        # 管道写满(约64KB)后aria2c会阻塞，因此输出写入文件
+        log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_CLOEXEC, 0o644)
+        try:
+            return subprocess.Popen(cmd, stdout=log_fd, stderr=subprocess.STDOUT)
+        finally:
+            os.close(log_fd)  # 子进程持有自己的副本
+    
+    def _read_total_length(self, log_path: str) -> Optional[int]:
+        """Parse the latest 'Total Length' reported in the tail of an aria2c log"""
+        try:
+            with open(log_path, 'rb') as f:
+                f.seek(max(os.fstat(f.fileno()).st_size - ARIA2_LOG_TAIL, 0))
+                tail = f.read()
+        except OSError:
+            return None
+        # 只需要最后一次出现的值，无需解码整段日志
+        match = None
+        for match in _TOTAL_LENGTH_RE.finditer(tail):
+            pass
+        if match is None:
+            return None
+        return int((match.group(1) or match.group(2)).replace(b',', b''))
+    
+    def _complete_download(self, download_id: str, download_info: Dict) -> None:
+        """Mark a finished download as completed and copy it into the conversation files"""
+        target_path = download_info['target_path']
+        file_size = os.path.getsize(target_path)
+        
+        # 成功下载，更新状态；下载完成，速度与剩余时间为0
+        # 期间已被取消或暂停时保留用户操作的结果，也不再移动文件
+        if not self._publish(download_id, download_info, expect='downloading', status='completed', progress=100,
+                             size=file_size, downloaded_size=file_size, speed=0, eta=0):
+            return
+        
+        # 移动到用户文件目录
+        files_dir = self.get_conversation_files_dir(download_info['conversation_id'])
+        dest_path = os.path.join(files_dir, os.path.basename(target_path))
+        try:
+            if os.stat(target_path).st_dev == os.stat(files_dir).st_dev:
+                # 同一文件系统内直接重命名，不拷贝任何数据
+                os.replace(target_path, dest_path)
+            else:
+                # 跨文件系统时 copy2 在 Linux 上会使用 sendfile 拷贝
+                shutil.copy2(target_path, dest_path)
+            self._invalidate_tree(download_info['conversation_id'])
+        except Exception as e:
+            logger.error(f"移动下载文件错误: {e}")
+    
+    def _set_download_status(self, download_id: str, download_info: Dict, status: str,
+                             expect: Optional[str] = None) -> bool:
+        """Set the status of a download in both bookkeeping dicts"""
+        return self._publish(download_id, download_info, expect=expect, status=status)
+    
+    def _publish(self, download_id: str, download_info: Dict, expect: Optional[str] = None, **fields: Any) -> bool:
+        """Apply fields to a download and swap in an updated copy of its status entry.
+        
+        Readers always get a whole snapshot instead of a half-updated dict; the stripe lock only covers the swap.
+        With expect, nothing is written unless the download is still in that status under the lock, so the
+        monitor never overwrites a cancel/pause that raced with it. Returns whether the fields were applied.
+        """
+        with self._lock_for(download_id):
+            if expect is not None and download_info['status'] != expect:
+                return False
+            self._publish_locked(download_id, download_info, **fields)
+            return True
+    
+    def _publish_locked(self, download_id: str, download_info: Dict, **fields: Any) -> None:
+        """Same as _publish for callers already holding the download's stripe lock"""
+        download_info.update(fields)
+        entry = self.download_status.get(download_id)
+        if entry is not None:
+            self.download_status[download_id] = {**entry, **fields}
+    
+    def _aria2_call(self, method: str, *params: Any) -> Any:
+        """Call a method on the aria2 JSON-RPC interface"""
+        if ARIA2_RPC_SECRET:
+            params = (f"token:{ARIA2_RPC_SECRET}",) + params
+        payload = json.dumps({
+            'jsonrpc': '2.0',
+            'id': 'autopipe',
+            'method': method,
+            'params': list(params)
+        }).encode('utf-8')
+        req = urllib.request.Request(ARIA2_RPC_URL, data=payload, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            reply = json.loads(resp.read())
+        if 'error' in reply:
+            raise ValueError(f"aria2 {method} 失败: {reply['error'].get('message')}")
+        return reply.get('result')
+    
+    def _poll_aria2_download(self, download_id: str, download_info: Dict) -> None:
+        """Refresh a download handled by the aria2 daemon from aria2.tellStatus"""
+        try:
+            status = self._aria2_call(
+                'aria2.tellStatus', download_info['gid'],
+                ['status', 'totalLength', 'completedLength', 'downloadSpeed', 'errorMessage']
+            )
+        except Exception as e:
+            logger.error(f"获取aria2下载状态错误: {e}")
+            return
+        
+        state = status.get('status')
+        if state == 'complete':
+            if os.path.exists(download_info['target_path']):
+                self._complete_download(download_id, download_info)
+            else:
+                self._set_download_status(download_id, download_info, 'failed', expect='downloading')
+            return
+        if state in ('error', 'removed'):
+            logger.warning(f"aria2下载 {download_id} 结束: {state} {status.get('errorMessage', '')}")
+            self._set_download_status(download_id, download_info, 'failed', expect='downloading')
+            return
+        
+        # active / waiting / paused: aria2直接给出真实的大小和速度
+        total_size = int(status.get('totalLength', 0))
+        current_size = int(status.get('completedLength', 0))
+        speed = int(status.get('downloadSpeed', 0))
+        progress = min(int(current_size * 100 / total_size), 99) if total_size > 0 else 0
+        eta = (total_size - current_size) / speed if speed > 0 and total_size > current_size else 0
+        self._note_speed(download_info.get('speed', 0), speed)
+        
+        fields = {'progress': progress, 'downloaded_size': current_size, 'speed': speed, 'eta': eta}
+        if total_size > 0:
+            fields['size'] = total_size
+        self._publish(download_id, download_info, expect='downloading', **fields)
@@ -2,57 +2,93 @@ import os
 import psutil
 import platform
 import time
+import heapq
 import logging
-from typing import Dict, List, Any, Optional
+from collections import deque
+from functools import lru_cache
+from operator import itemgetter
+from typing import Dict, List, Any, Optional, Tuple
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+# 日志由应用入口统一配置，这里只获取模块logger
 logger = logging.getLogger(__name__)
 
+_BY_CPU = itemgetter('cpu_percent')
+
+@lru_cache(maxsize=1)
+def _static_info() -> Dict:
+    """静态系统信息在进程生命周期内不变，只采集一次（所有实例共享）
+    
+    platform.processor() 在部分版本会调用 uname 子进程
+    """
+    return {
+        'system': platform.system(),
+        'node': platform.node(),
+        'release': platform.release(),
+        'version': platform.version(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': psutil.cpu_count(logical=False),
+        'cpu_count_logical': psutil.cpu_count(logical=True),
+        'memory_total': psutil.virtual_memory().total,
+        'boot_time': psutil.boot_time()
+    }
+
+PROC_STAT = '/proc/stat'
+PROC_STAT_READ_SIZE = 64 * 1024  # cpu 行位于文件开头，足够覆盖上千个CPU
+
 class MonitorService:
     """服务用于监控系统性能指标"""
     
+    MAX_PROCESSES = 200  # 进程列表最多返回的条目数
+    DISK_TTL = 5.0  # 磁盘用量变化缓慢，statvfs 结果缓存的秒数
+    
     def __init__(self):
+        self.max_history_points = 60  # 保存最近60个数据点
+        # 固定长度的环形缓冲，追加时自动淘汰最旧的数据点
         self.history = {
-            'cpu': [],
-            'memory': [],
-            'disk': [],
-            'network': []
+            key: deque(maxlen=self.max_history_points)
+            for key in ('cpu', 'memory', 'disk', 'network')
         }
-        self.max_history_points = 60  # 保存最近60个数据点
+        
+        # 在构造时预先采集静态系统信息，之后的请求都命中缓存
+        self._memory_total = _static_info()['memory_total']
+        self._disk_cache = (0.0, None)  # (采集时间, psutil.disk_usage 结果)
+        self._last_sample_time = 0.0  # 上一个历史点的单调时间
 
-        # 预热 psutil.cpu_percent 调用
-        # 这些首次调用会返回 0.0 或 [0.0,...] 并为后续非阻塞调用建立基准
-        psutil.cpu_percent(interval=None)
-        psutil.cpu_percent(interval=None, percpu=True)
+        # Linux 上保持 /proc/stat 常开，每次只 pread 一次并自行计算差值；其他平台回退到 psutil
+        try:
+            self._stat_fd = os.open(PROC_STAT, os.O_RDONLY)
+            self._prev_ticks = self._read_cpu_ticks()
+        except (OSError, ValueError):
+            self._stat_fd = None
+            # 预热 psutil.cpu_percent 调用
+            # 这些首次调用会返回 0.0 或 [0.0,...] 并为后续非阻塞调用建立基准
+            psutil.cpu_percent(interval=None)
+            psutil.cpu_percent(interval=None, percpu=True)
         # 短暂休眠，确保第一次实际度量时有时间流逝
         time.sleep(0.05)
     
     def get_system_info(self) -> Dict:
         """获取系统基本信息"""
-        info = {
-            'system': platform.system(),
-            'node': platform.node(),
-            'release': platform.release(),
-            'version': platform.version(),
-            'machine': platform.machine(),
-            'processor': platform.processor(),
-            'cpu_count': psutil.cpu_count(logical=False),
-            'cpu_count_logical': psutil.cpu_count(logical=True),
-            'memory_total': psutil.virtual_memory().total,
-            'boot_time': psutil.boot_time()
-        }
-        return info
+        # 返回副本，调用方修改不会污染缓存
+        return dict(_static_info())
     
     def get_current_metrics(self) -> Dict:
         """获取当前系统指标"""
-        # 使用 interval=None 进行非阻塞调用
-        # 这将返回自上次调用（或__init__中的预热调用）以来的CPU使用百分比
-        cpu_percent_val = psutil.cpu_percent(interval=None)
-        per_cpu_val = psutil.cpu_percent(interval=None, percpu=True)
+        percents = self._cpu_percents() if self._stat_fd is not None else None
+        if percents:
+            cpu_percent_val, per_cpu_val = percents[0], percents[1:]
+        else:
+            # 使用 interval=None 进行非阻塞调用
+            # 这将返回自上次调用（或__init__中的预热调用）以来的CPU使用百分比
+            cpu_percent_val = psutil.cpu_percent(interval=None)
+            per_cpu_val = psutil.cpu_percent(interval=None, percpu=True)
         
         memory = psutil.virtual_memory()
-        disk = psutil.disk_usage('/')
+        now = time.monotonic()
+        if self._disk_cache[1] is None or now - self._disk_cache[0] > self.DISK_TTL:
+            self._disk_cache = (now, psutil.disk_usage('/'))
+        disk = self._disk_cache[1]
         net_io = psutil.net_io_counters()
         
         metrics = {
@@ -62,7 +98,7 @@ class MonitorService:
                 'per_cpu': per_cpu_val
             },
             'memory': {
-                'total': memory.total,
+                'total': self._memory_total,
                 'available': memory.available,
                 'used': memory.used,
                 'percent': memory.percent
@@ -82,80 +118,77 @@ class MonitorService:
         }
         
         # 更新历史数据
-        self._update_history(metrics)
+        self._update_history(metrics, now)
         
         return metrics
     
+    def _read_cpu_ticks(self) -> List[Tuple[int, int]]:
+        """读取 /proc/stat 中汇总行及每个CPU的 (busy, total) 时钟数"""
+        data = os.pread(self._stat_fd, PROC_STAT_READ_SIZE, 0)
+        ticks = []
+        for line in data.split(b'\n'):
+            # cpu 行总在文件开头
+            if not line.startswith(b'cpu'):
+                break
+            # user nice system idle iowait irq softirq steal；guest 已计入 user/nice，与 psutil 一致不重复计算
+            values = [int(v) for v in line.split()[1:9]]
+            total = sum(values)
+            ticks.append((total - values[3] - values[4], total))
+        return ticks
+    
+    def _cpu_percents(self) -> List[float]:
+        """与上次读取相比的CPU使用率：第一个为总体，其余为每个CPU"""
+        try:
+            ticks = self._read_cpu_ticks()
+        except (OSError, ValueError) as e:
+            logger.error(f"读取 {PROC_STAT} 失败: {e}")
+            return []
+        prev, self._prev_ticks = self._prev_ticks, ticks
+        if len(prev) != len(ticks):
+            # CPU 热插拔后基准失效，本次返回0
+            return [0.0] * len(ticks)
+        
+        percents = []
+        for (busy, total), (prev_busy, prev_total) in zip(ticks, prev):
+            total_diff = total - prev_total
+            if total_diff <= 0:
+                percents.append(0.0)
+            else:
+                percents.append(round(min(max((busy - prev_busy) * 100.0 / total_diff, 0.0), 100.0), 1))
+        return percents
+    
     def get_process_info(self, include_python_only: bool = False) -> List[Dict]:
         """获取进程信息"""
         processes = []
         
         try:
-            # 首先尝试使用标准方式获取所有进程
-            for proc in psutil.process_iter(['pid', 'name', 'username', 'cpu_percent', 'memory_percent', 'create_time']):
-                try:
-                    pinfo = proc.info
-                    
-                    # 处理可能存在的None值
-                    if pinfo['cpu_percent'] is None:
-                        pinfo['cpu_percent'] = 0.0
-                    
-                    if pinfo['memory_percent'] is None:
-                        pinfo['memory_percent'] = 0.0
-                    
-                    if pinfo['create_time'] is None:
-                        pinfo['create_time'] = 0.0
-                    
-                    # 仅包含Python进程（可选）
-                    if include_python_only and 'python' not in str(pinfo['name']).lower():
-                        continue
-                    
-                    processes.append({
-                        'pid': pinfo['pid'],
-                        'name': pinfo.get('name', 'unknown'),
-                        'username': pinfo.get('username', 'unknown'),
-                        'cpu_percent': float(pinfo['cpu_percent']),
-                        'memory_percent': float(pinfo['memory_percent']),
-                        'create_time': float(pinfo['create_time'])
-                    })
-                except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-                    pass
-                except Exception as e:
-                    logger.error(f"处理进程信息时出错: {str(e)}")
-        
-            # 如果没有获取到任何进程信息（可能是权限问题），尝试只获取当前用户的进程
-            if len(processes) == 0:
-                logger.warning("无法获取所有进程信息，尝试只获取当前用户的进程")
-                import os
+            # 单次遍历；oneshot() 让同一进程的多个属性共用一次 /proc 读取
+            # 单个进程的 AccessDenied 只跳过该字段/进程，因此不再需要"仅当前用户"的第二轮遍历
+            for proc in psutil.process_iter():
                 try:
-                    current_user = os.getlogin()
-                except:
-                    current_user = 'current'
-                
-                for proc in psutil.process_iter(['pid', 'name', 'username', 'cpu_percent', 'memory_percent', 'create_time']):
-                    try:
-                        pinfo = proc.info
-                        
-                        # 只包含当前用户的进程
-                        if pinfo['username'] != current_user:
+                    with proc.oneshot():
+                        name = proc.name()
+                        # 仅包含Python进程（可选），在读取其他字段之前过滤
+                        if include_python_only and 'python' not in name.lower():
                             continue
                         
-                        # 仅包含Python进程（可选）
-                        if include_python_only and 'python' not in str(pinfo['name']).lower():
-                            continue
+                        try:
+                            username = proc.username()
+                        except (psutil.AccessDenied, KeyError):
+                            username = 'unknown'
                         
                         processes.append({
-                            'pid': pinfo['pid'],
-                            'name': pinfo.get('name', 'unknown'),
-                            'username': pinfo.get('username', 'unknown'),
-                            'cpu_percent': float(pinfo['cpu_percent']),
-                            'memory_percent': float(pinfo['memory_percent']),
-                            'create_time': float(pinfo['create_time'])
+                            'pid': proc.pid,
+                            'name': name or 'unknown',
+                            'username': username,
+                            'cpu_percent': float(proc.cpu_percent() or 0.0),
+                            'memory_percent': float(proc.memory_percent() or 0.0),
+                            'create_time': float(proc.create_time() or 0.0)
                         })
-                    except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-                        pass
-                    except Exception as e:
-                        logger.error(f"处理当前用户进程信息时出错: {str(e)}")
+                except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                    pass
+                except Exception as e:
+                    logger.error(f"处理进程信息时出错: {str(e)}")
         except Exception as e:
             logger.error(f"获取进程信息时发生错误: {str(e)}")
             # 返回至少一个进程的信息 - 当前Python进程
@@ -186,8 +219,8 @@ class MonitorService:
                     'create_time': 0.0
                 })
         
-        # 按CPU使用率排序
-        return sorted(processes, key=lambda x: x['cpu_percent'] or 0.0, reverse=True)
+        # 按CPU使用率取前N个，无需对全部进程排序
+        return heapq.nlargest(self.MAX_PROCESSES, processes, key=_BY_CPU)
     
     def get_history(self, metric_type: str = None, points: int = None) -> Dict:
         """获取历史性能数据"""
@@ -195,7 +228,7 @@ class MonitorService:
             if metric_type not in self.history:
                 raise ValueError(f"Invalid metric type: {metric_type}")
             
-            data = self.history[metric_type]
+            data = list(self.history[metric_type])
             if points is not None:
                 data = data[-points:]
             
@@ -203,6 +236,7 @@ class MonitorService:
         
         result = {}
         for key, data in self.history.items():
+            data = list(data)
             if points is not None:
                 result[key] = data[-points:]
             else:
@@ -210,7 +244,7 @@ class MonitorService:
         
         return result
     
-    def _update_history(self, metrics: Dict):
+    def _update_history(self, metrics: Dict, now: float):
         """更新历史数据"""
         self.history['cpu'].append({
             'timestamp': metrics['timestamp'],
@@ -228,9 +262,10 @@ class MonitorService:
         })
         
         # 计算网络速率（与上一个点相比）
+        # 速率用单调时钟计算，系统时钟调整不会产生负值或尖峰；timestamp 仍用于展示
         if self.history['network']:
             last = self.history['network'][-1]
-            time_diff = metrics['timestamp'] - last['timestamp']
+            time_diff = now - self._last_sample_time
             if time_diff > 0:
                 bytes_sent_rate = (metrics['network']['bytes_sent'] - last['bytes_sent']) / time_diff
                 bytes_recv_rate = (metrics['network']['bytes_recv'] - last['bytes_recv']) / time_diff
@@ -248,8 +283,4 @@ class MonitorService:
             'bytes_sent_rate': bytes_sent_rate,
             'bytes_recv_rate': bytes_recv_rate
         })
-        
-        # 限制历史数据点数量
-        for key in self.history:
-            if len(self.history[key]) > self.max_history_points:
-                self.history[key] = self.history[key][-self.max_history_points:] 
\ No newline at end of file
+        self._last_sample_time = now
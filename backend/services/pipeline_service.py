@@ -1,14 +1,26 @@
 import os
+import io
+import copy
 import json
+import shlex
+import signal
 import uuid
 import subprocess
 import shutil
+import tempfile
 import time
-from typing import Dict, List, Any, Optional
+import threading
+import selectors
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Any, Optional, Tuple
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+try:
+    import orjson
+except ImportError:
+    orjson = None  # Fall back to the standard library json
+
+# Logging is configured by the application entry point
 logger = logging.getLogger(__name__)
 
 # Data directories
@@ -22,11 +34,93 @@ os.makedirs(PLANS_DIR, exist_ok=True)
 os.makedirs(FILES_DIR, exist_ok=True)
 os.makedirs(LOGS_DIR, exist_ok=True)
 
+def _dumps(obj: Any, indent: bool = False) -> bytes:
+    """Serialize to JSON bytes (orjson when available)"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None)
+    return json.dumps(obj, indent=2 if indent else None).encode('utf-8')
+
+def _loads(data: bytes) -> Any:
+    """Parse JSON bytes (orjson when available)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _atomic_write(path: str, data: bytes) -> None:
+    """Write a temp file next to path and swap it in, so a crash never leaves a truncated file behind"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def _summary(workflow: Dict) -> Dict:
+    """Summary fields of a workflow as returned by list_workflows"""
+    return {
+        "id": workflow.get('id'),
+        "title": workflow.get('title'),
+        "conversation_id": workflow.get('conversation_id'),
+        "created_at": workflow.get('created_at'),
+        "status": workflow.get('status')
+    }
+
+# Threads used to read plan files when the plan index has to be rebuilt
+INDEX_SCAN_WORKERS = 16
+
+# Seconds a step may run before its process group is killed
+STEP_TIMEOUT = 600
+# How often the reaper checks step deadlines (and exits, where pidfds are unavailable)
+REAPER_INTERVAL = 1.0
+
+# Bytes read from each end of a step log when building its truncated output
+OUTPUT_CHUNK_SIZE = 256 * 1024
+
+def _decode_lines(data: bytes) -> List[str]:
+    """Split raw log bytes into lines with universal newlines, like reading the file in text mode"""
+    return io.TextIOWrapper(io.BytesIO(data), encoding='utf-8', errors='replace').readlines()
+
+# Characters that need a shell to interpret; commands containing none of them are exec'd directly
+_SHELL_META = frozenset('|&;<>$`()*?[]{}~#!\n\\')
+
+def _direct_argv(command: str) -> Optional[List[str]]:
+    """Return the argv for a command that can run without a shell, or None if it needs one"""
+    if any(c in _SHELL_META for c in command):
+        return None
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        return None
+    # Empty commands, variable assignments, paths (resolved against the step's cwd by the shell)
+    # and builtins/keywords (cd, export, if ...) stay with the shell
+    if not argv or '=' in argv[0] or '/' in argv[0] or shutil.which(argv[0]) is None:
+        return None
+    return argv
+
 class PipelineService:
     """Service for managing bioinformatics workflows"""
     
     def __init__(self, llm_service=None):
         self.llm_service = llm_service
+        # Serializes read-modify-write of plan files so concurrently executing steps don't overwrite each other
+        self._workflow_lock = threading.Lock()
+        # plan_id -> (on-disk stamp, workflow with replayed status), guarded by _workflow_lock
+        self._workflow_cache: Dict[str, Tuple[tuple, Dict]] = {}
+        # Summary of every plan for list_workflows, mirrored to index.json
+        self._index_path = os.path.join(PLANS_DIR, 'index.json')
+        self._index = None
+        self._index_lock = threading.Lock()
+        # Running steps keyed by pid; a single reaper thread waits on all of them
+        self._running = {}
+        self._running_lock = threading.Lock()
+        self._reaper = None
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
     
     def get_conversation_files_dir(self, conversation_id: str) -> str:
         """Get the directory for conversation files"""
@@ -64,12 +158,15 @@ class PipelineService:
                     "id": "step1",
                     "title": "Step Title",
                     "command": "bash command to execute",
-                    "description": "Detailed explanation of what this step does"
+                    "description": "Detailed explanation of what this step does",
+                    "parallel_safe": false
                 }},
                 ...
             ]
         }}
         
+        Set "parallel_safe" to true only for steps that neither depend on nor affect the outputs of
+        neighbouring steps, so that they can be executed concurrently.
         Ensure that all commands correctly reference the file paths within the workflow directory. 
         Use best practices for bioinformatics workflows and include appropriate tools like FastQC, 
         BWA, STAR, Samtools, GATK, etc. as needed.
@@ -198,133 +295,406 @@ class PipelineService:
                 ]
             }
     
+    def _status_path(self, plan_id: str) -> str:
+        """Path of the append-only step status log that accompanies a plan file"""
+        return os.path.join(PLANS_DIR, f"plan_{plan_id}.status.jsonl")
+    
     def _save_workflow(self, plan_id: str, workflow: Dict) -> None:
-        """Save workflow plan to disk"""
+        """Save workflow plan to disk.
+        
+        Runs under _workflow_lock: step results recorded since the caller read the workflow are merged
+        in from the current plan and status log before the log is truncated, so none are lost.
+        """
         plan_path = os.path.join(PLANS_DIR, f"plan_{plan_id}.json")
-        with open(plan_path, 'w') as f:
-            json.dump(workflow, f, indent=2)
+        with self._workflow_lock:
+            current = self._load_workflow(plan_id)
+            if current is not None:
+                # Same rule as update_workflow: results carry over only for steps whose command is unchanged
+                current_steps = {step.get('id'): step for step in current.get('steps', [])}
+                for step in workflow.get('steps', []):
+                    latest = current_steps.get(step.get('id'))
+                    if latest is not None and latest.get('command') == step.get('command'):
+                        for key in ('status', 'output', 'error', 'start_time', 'end_time'):
+                            if key in latest:
+                                step[key] = latest[key]
+                if workflow.get('status') != 'modified' and 'status' in current:
+                    workflow['status'] = current['status']
+            
+            _atomic_write(plan_path, _dumps(workflow, indent=True))
+            # The full snapshot now contains every replayed status, so the log starts over
+            try:
+                os.remove(self._status_path(plan_id))
+            except FileNotFoundError:
+                pass
+            self._workflow_cache.pop(plan_id, None)
+        self._update_index(plan_id, summary=_summary(workflow))
+    
+    def _append_status(self, plan_id: str, record: Dict, sync: bool = False) -> None:
+        """Append one step status transition instead of rewriting the whole plan file"""
+        line = _dumps(record) + b"\n"
+        with open(self._status_path(plan_id), 'ab') as f:
+            f.write(line)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+    
+    def _replay_status(self, plan_id: str, workflow: Dict) -> Dict:
+        """Merge the step status log into a freshly loaded plan"""
+        try:
+            f = open(self._status_path(plan_id), 'rb')
+        except FileNotFoundError:
+            return workflow
+        
+        steps = {step.get('id'): step for step in workflow.get('steps', [])}
+        with f:
+            for line in f:
+                try:
+                    record = _loads(line)
+                except ValueError:
+                    # A torn last line from an interrupted append
+                    continue
+                workflow_status = record.pop('workflow_status', None)
+                step = steps.get(record.pop('step_id', None))
+                if step is not None:
+                    step.update(record)
+                if workflow_status:
+                    workflow['status'] = workflow_status
+        return workflow
     
     def get_workflow(self, plan_id: str) -> Optional[Dict]:
         """Retrieve a workflow plan by ID"""
-        plan_path = os.path.join(PLANS_DIR, f"plan_{plan_id}.json")
-        if not os.path.exists(plan_path):
+        with self._workflow_lock:
+            workflow = self._load_workflow(plan_id)
+            # Callers get their own copy; the cached workflow is only modified under the lock
+            return copy.deepcopy(workflow) if workflow is not None else None
+    
+    def _plan_stamp(self, plan_id: str) -> Optional[tuple]:
+        """Identify the on-disk state of a plan and its status log, None if the plan doesn't exist"""
+        try:
+            st = os.stat(os.path.join(PLANS_DIR, f"plan_{plan_id}.json"))
+        except FileNotFoundError:
             return None
-            
-        with open(plan_path, 'r') as f:
-            return json.load(f)
+        try:
+            log_size = os.stat(self._status_path(plan_id)).st_size
+        except FileNotFoundError:
+            log_size = -1
+        return (st.st_mtime_ns, st.st_size, log_size)
+    
+    def _load_workflow(self, plan_id: str) -> Optional[Dict]:
+        """Return the cached workflow, re-parsing it only when the plan or its status log changed on disk.
+        
+        The returned dict is shared; caller holds _workflow_lock.
+        """
+        stamp = self._plan_stamp(plan_id)
+        if stamp is None:
+            self._workflow_cache.pop(plan_id, None)
+            return None
+        
+        cached = self._workflow_cache.get(plan_id)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        
+        with open(os.path.join(PLANS_DIR, f"plan_{plan_id}.json"), 'rb') as f:
+            workflow = self._replay_status(plan_id, _loads(f.read()))
+        self._workflow_cache[plan_id] = (stamp, workflow)
+        return workflow
     
     def list_workflows(self, conversation_id: Optional[str] = None) -> List[Dict]:
         """List all workflows, optionally filtered by conversation_id"""
-        workflows = []
-        
-        for filename in os.listdir(PLANS_DIR):
-            if filename.startswith("plan_") and filename.endswith(".json"):
-                plan_path = os.path.join(PLANS_DIR, filename)
-                with open(plan_path, 'r') as f:
-                    workflow = json.load(f)
-                    
-                if conversation_id is None or workflow.get('conversation_id') == conversation_id:
-                    # Include only summary information
-                    workflows.append({
-                        "id": workflow.get('id'),
-                        "title": workflow.get('title'),
-                        "conversation_id": workflow.get('conversation_id'),
-                        "created_at": workflow.get('created_at'),
-                        "status": workflow.get('status')
-                    })
+        # Summaries come from the plan index, so no plan file has to be opened here
+        with self._index_lock:
+            workflows = [
+                dict(summary) for summary in self._load_index().values()
+                if conversation_id is None or summary.get('conversation_id') == conversation_id
+            ]
         
         return sorted(workflows, key=lambda w: w.get('created_at', 0), reverse=True)
     
+    def _load_index(self) -> Dict[str, Dict]:
+        """Return the in-memory plan index, reading or rebuilding it on first use. Caller holds _index_lock."""
+        if self._index is None:
+            try:
+                with open(self._index_path, 'rb') as f:
+                    self._index = _loads(f.read())
+            except (OSError, ValueError):
+                self._index = self._rebuild_index()
+        return self._index
+    
+    def _rebuild_index(self) -> Dict[str, Dict]:
+        """Build the plan index by scanning every plan file (used when index.json is missing or unreadable)"""
+        with os.scandir(PLANS_DIR) as it:
+            plan_ids = [
+                entry.name[len("plan_"):-len(".json")] for entry in it
+                if entry.name.startswith("plan_") and entry.name.endswith(".json")
+            ]
+        
+        # Reading plan files is latency bound, so overlap the reads (helps most on network filesystems)
+        index = {}
+        if plan_ids:
+            with ThreadPoolExecutor(max_workers=min(INDEX_SCAN_WORKERS, len(plan_ids))) as executor:
+                for plan_id, summary in zip(plan_ids, executor.map(self._read_summary, plan_ids)):
+                    if summary is not None:
+                        index[plan_id] = summary
+        _atomic_write(self._index_path, _dumps(index))
+        return index
+    
+    def _read_summary(self, plan_id: str) -> Optional[Dict]:
+        """Load one plan file with its status log and return its summary, None if it can't be read"""
+        try:
+            with open(os.path.join(PLANS_DIR, f"plan_{plan_id}.json"), 'rb') as f:
+                workflow = _loads(f.read())
+            return _summary(self._replay_status(plan_id, workflow))
+        except (OSError, ValueError) as e:
+            logger.error(f"Skipping unreadable plan file plan_{plan_id}.json: {e}")
+            return None
+    
+    def _update_index(self, plan_id: str, summary: Optional[Dict] = None, status: Optional[str] = None) -> None:
+        """Store a plan's summary (or just its new status) in the index and persist it"""
+        with self._index_lock:
+            index = self._load_index()
+            if summary is not None:
+                index[plan_id] = summary
+            elif plan_id in index and index[plan_id].get('status') != status:
+                index[plan_id]['status'] = status
+            else:
+                return
+            _atomic_write(self._index_path, _dumps(index))
+    
     def execute_step(self, plan_id: str, step_id: str, conversation_id: str) -> Dict:
         """Execute a specific step in a workflow"""
-        workflow = self.get_workflow(plan_id)
-        if not workflow:
-            raise ValueError(f"Workflow plan {plan_id} not found")
-        
-        # Find the step to execute
-        target_step = None
-        for step in workflow.get('steps', []):
-            if step.get('id') == step_id:
-                target_step = step
-                break
+        return self.start_step(plan_id, step_id, conversation_id).result()
+    
+    def start_step(self, plan_id: str, step_id: str, conversation_id: str) -> Future:
+        """Start a workflow step and return a future resolving to the updated step.
         
-        if not target_step:
-            raise ValueError(f"Step {step_id} not found in workflow {plan_id}")
+        The calling thread does not wait on the process; a single reaper thread collects every running step.
+        """
+        with self._workflow_lock:
+            workflow = self._load_workflow(plan_id)
+            if not workflow:
+                raise ValueError(f"Workflow plan {plan_id} not found")
+            
+            # Find the step to execute
+            target_step = None
+            for step in workflow.get('steps', []):
+                if step.get('id') == step_id:
+                    target_step = step
+                    break
+            
+            if not target_step:
+                raise ValueError(f"Step {step_id} not found in workflow {plan_id}")
+            command = target_step['command']
         
         # Prepare working directory (using conversation files directory)
         work_dir = self.get_conversation_files_dir(conversation_id)
         
         # Update step status
-        target_step['status'] = 'running'
-        target_step['start_time'] = time.time()
-        self._save_workflow(plan_id, workflow)
+        self._update_step(plan_id, step_id, {'status': 'running', 'start_time': time.time()})
         
         # Execute the command
         log_file_path = os.path.join(LOGS_DIR, f"{plan_id}_{step_id}.log")
+        future = Future()
         
         try:
-            with open(log_file_path, 'w') as log_file:
+            argv = _direct_argv(command)
+            # A raw fd is enough for a file only the child writes to; the child keeps its own dup
+            log_fd = os.open(log_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644)
+            try:
+                # Simple commands are exec'd directly, skipping the intermediate /bin/sh.
+                # A new session lets a timeout kill the whole process group, not just the shell.
                 process = subprocess.Popen(
-                    target_step['command'],
-                    shell=True,
-                    stdout=log_file,
+                    argv if argv is not None else command,
+                    shell=argv is None,
+                    stdout=log_fd,
                     stderr=subprocess.STDOUT,
-                    cwd=work_dir
+                    cwd=work_dir,
+                    start_new_session=True
                 )
-                
-                # Wait for process to complete (with timeout)
-                try:
-                    return_code = process.wait(timeout=600)  # 10-minute timeout
-                    
-                    if return_code == 0:
-                        target_step['status'] = 'completed'
-                        target_step['output'] = self._get_truncated_output(log_file_path)
-                    else:
-                        target_step['status'] = 'failed'
-                        target_step['error'] = f"Command failed with return code {return_code}"
-                        target_step['output'] = self._get_truncated_output(log_file_path)
-                
-                except subprocess.TimeoutExpired:
-                    process.kill()
-                    target_step['status'] = 'timeout'
-                    target_step['error'] = "Command execution timed out after 10 minutes"
+            finally:
+                os.close(log_fd)
+        except Exception as e:
+            self._finish_step(plan_id, step_id, {'status': 'failed', 'error': str(e)}, future)
+            return future
+        
+        running = {
+            'plan_id': plan_id,
+            'step_id': step_id,
+            'process': process,
+            'log_path': log_file_path,
+            'deadline': time.monotonic() + STEP_TIMEOUT,
+            'future': future,
+            'pidfd': None
+        }
+        with self._running_lock:
+            self._running[process.pid] = running
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap_steps, name='pipeline-reaper', daemon=True)
+                self._reaper.start()
+        try:
+            os.write(self._wake_w, b'\0')
+        except BlockingIOError:
+            pass  # The reaper already has unread wakeups pending
+        
+        return future
+    
+    def _reap_steps(self) -> None:
+        """Wait on all running steps from one thread: pidfd readiness through the selector, deadlines by scan"""
+        next_scan = time.monotonic() + REAPER_INTERVAL
+        while True:
+            with self._running_lock:
+                running = list(self._running.values())
+            
+            # Steps started since the last pass get their pidfd registered here, so only this thread touches the selector
+            for entry in running:
+                if entry['pidfd'] is None and hasattr(os, 'pidfd_open'):
+                    try:
+                        entry['pidfd'] = os.pidfd_open(entry['process'].pid)
+                        self._selector.register(entry['pidfd'], selectors.EVENT_READ, entry)
+                    except OSError:
+                        entry['pidfd'] = -1  # Without a pidfd the step is picked up by the periodic scan
+            
+            timeout = max(next_scan - time.monotonic(), 0) if running else None
+            for key, _ in self._selector.select(timeout):
+                if key.fd == self._wake_r:
+                    try:
+                        os.read(self._wake_r, 4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._collect_step(key.data)
+            
+            now = time.monotonic()
+            if now >= next_scan:
+                next_scan = now + REAPER_INTERVAL
+                for entry in running:
+                    if entry['process'].pid in self._running:
+                        self._collect_step(entry, timed_out=now >= entry['deadline'])
+    
+    def _collect_step(self, entry: Dict, timed_out: bool = False) -> None:
+        """Record the result of a step whose process exited or ran past its deadline"""
+        process = entry['process']
+        return_code = process.poll()
+        if return_code is None and not timed_out:
+            return
+        
+        if entry['pidfd'] is not None and entry['pidfd'] >= 0:
+            self._selector.unregister(entry['pidfd'])
+            os.close(entry['pidfd'])
+        with self._running_lock:
+            self._running.pop(process.pid, None)
         
+        result = {}
+        try:
+            if return_code is None:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                process.wait()
+                result['status'] = 'timeout'
+                result['error'] = "Command execution timed out after 10 minutes"
+            elif return_code == 0:
+                result['status'] = 'completed'
+                result['output'] = self._get_truncated_output(entry['log_path'])
+            else:
+                result['status'] = 'failed'
+                result['error'] = f"Command failed with return code {return_code}"
+                result['output'] = self._get_truncated_output(entry['log_path'])
         except Exception as e:
-            target_step['status'] = 'failed'
-            target_step['error'] = str(e)
+            result['status'] = 'failed'
+            result['error'] = str(e)
         
+        self._finish_step(entry['plan_id'], entry['step_id'], result, entry['future'])
+    
+    def _finish_step(self, plan_id: str, step_id: str, result: Dict, future: Future) -> None:
+        """Store a step's final result and resolve its future"""
         # Update completion time
-        target_step['end_time'] = time.time()
-        
-        # Check if all steps are completed to update workflow status
-        all_completed = all(
-            step.get('status', '') == 'completed' 
-            for step in workflow.get('steps', [])
-        )
-        
-        if all_completed:
-            workflow['status'] = 'completed'
-        elif any(step.get('status', '') == 'failed' for step in workflow.get('steps', [])):
-            workflow['status'] = 'failed'
-        else:
-            workflow['status'] = 'in_progress'
-        
-        self._save_workflow(plan_id, workflow)
+        result['end_time'] = time.time()
+        try:
+            future.set_result(self._update_step(plan_id, step_id, result, refresh_status=True))
+        except Exception as e:
+            future.set_exception(e)
+    
+    def _update_step(self, plan_id: str, step_id: str, fields: Dict, refresh_status: bool = False) -> Dict:
+        """Merge fields into a step of the stored workflow and record the change.
         
-        return target_step
+        The workflow is re-read under the lock so results of steps executing concurrently are preserved.
+        Only the changed fields are appended to the status log; the plan file itself is not rewritten,
+        and the cached workflow is updated in place instead of being parsed again.
+        """
+        with self._workflow_lock:
+            workflow = self._load_workflow(plan_id)
+            if not workflow:
+                raise ValueError(f"Workflow plan {plan_id} not found")
+            
+            target_step = next((step for step in workflow.get('steps', []) if step.get('id') == step_id), None)
+            if not target_step:
+                raise ValueError(f"Step {step_id} not found in workflow {plan_id}")
+            
+            target_step.update(fields)
+            record = {'step_id': step_id, **fields}
+            
+            if refresh_status:
+                # Check if all steps are completed to update workflow status
+                all_completed = all(
+                    step.get('status', '') == 'completed' 
+                    for step in workflow.get('steps', [])
+                )
+                
+                if all_completed:
+                    workflow['status'] = 'completed'
+                elif any(step.get('status', '') == 'failed' for step in workflow.get('steps', [])):
+                    workflow['status'] = 'failed'
+                else:
+                    workflow['status'] = 'in_progress'
+                record['workflow_status'] = workflow['status']
+            
+            # Terminal step states are synced so a finished result survives a crash
+            try:
+                self._append_status(plan_id, record, sync=refresh_status)
+            except BaseException:
+                # The cached copy is ahead of the disk now, drop it
+                self._workflow_cache.pop(plan_id, None)
+                raise
+            self._workflow_cache[plan_id] = (self._plan_stamp(plan_id), workflow)
+            if refresh_status:
+                self._update_index(plan_id, status=workflow['status'])
+            
+            return dict(target_step)
     
     def _get_truncated_output(self, log_file_path: str, max_lines: int = 1000) -> str:
-        """Get the output of a command, truncated if necessary"""
-        if not os.path.exists(log_file_path):
+        """Get the output of a command, truncated if necessary
+        
+        Only a bounded head and tail of the log are read, so memory use does not grow with the log size.
+        """
+        try:
+            fd = os.open(log_file_path, os.O_RDONLY)
+        except FileNotFoundError:
             return ""
-            
-        with open(log_file_path, 'r') as f:
-            lines = f.readlines()
-            
-        if len(lines) > max_lines:
-            output = "".join(lines[:max_lines//2])
-            output += f"\n... [output truncated, {len(lines) - max_lines} lines omitted] ...\n"
-            output += "".join(lines[-max_lines//2:])
-            return output
-        else:
-            return "".join(lines)
+        
+        half = max_lines // 2
+        try:
+            size = os.fstat(fd).st_size
+            if size <= 2 * OUTPUT_CHUNK_SIZE:
+                lines = _decode_lines(os.pread(fd, size, 0))
+                if len(lines) <= max_lines:
+                    return "".join(lines)
+                head, tail = lines[:half], lines[-half:]
+                omitted = f"{len(lines) - max_lines} lines"
+            else:
+                head = _decode_lines(os.pread(fd, OUTPUT_CHUNK_SIZE, 0))
+                # The last line of the head chunk is cut off unless the chunk happens to end on a newline
+                if head and not head[-1].endswith('\n'):
+                    head.pop()
+                head = head[:half]
+                # The first line of the tail chunk is almost always cut off, drop it
+                tail = _decode_lines(os.pread(fd, OUTPUT_CHUNK_SIZE, size - OUTPUT_CHUNK_SIZE))[1:][-half:]
+                shown = sum(len(line) for line in head) + sum(len(line) for line in tail)
+                omitted = f"~{max(size - shown, 0)} bytes"
+        finally:
+            os.close(fd)
+        
+        output = "".join(head)
+        output += f"\n... [output truncated, {omitted} omitted] ...\n"
+        output += "".join(tail)
+        return output
@@ -5,13 +5,19 @@ import logging
 import threading
 import time
 import json
+import re
 import shlex
 import signal
-import fcntl
-from typing import Dict, List, Any, Optional
+import codecs
+import selectors
+import shutil
+import heapq
+import itertools
+from collections import deque
+from functools import lru_cache
+from typing import Dict, List, Any, Optional, Tuple
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+# 日志由应用入口统一配置，这里只获取模块logger
 logger = logging.getLogger(__name__)
 
 # 数据目录
@@ -24,6 +30,19 @@ TERMINAL_LOGS_DIR = os.path.join(DATA_DIR, 'terminal_logs')
 for directory in [DATA_DIR, FILES_DIR, TERMINAL_LOGS_DIR]:
     os.makedirs(directory, exist_ok=True)
 
+# 命令输出管道的缓冲区大小
+PIPE_BUFSIZE = 64 * 1024
+# 每条命令保留在内存中的输出上限（字符），完整输出仍写入日志文件
+MAX_OUTPUT_CHARS = 4 * 1024 * 1024
+# 命令运行期间刷新实时输出的最小间隔（秒）
+LIVE_OUTPUT_INTERVAL = 0.25
+# 每个会话保留的命令历史条数，更早的记录（日志文件仍保留）从内存中移除
+MAX_SESSION_COMMANDS = 200
+# 终止进程时发送SIGTERM后等待其退出的时间（秒），超时再发送SIGKILL
+TERMINATE_GRACE = 0.5
+# 会话无活动多久后过期（秒）
+SESSION_TTL = 3600
+
 # ANSI颜色代码
 ANSI_COLORS = {
     'BLACK': '\033[30m',
@@ -38,23 +57,118 @@ ANSI_COLORS = {
     'BOLD': '\033[1m'
 }
 
+# 常用颜色预先取出，拼接输出时不必每次查字典
+RED = ANSI_COLORS['RED']
+GREEN = ANSI_COLORS['GREEN']
+YELLOW = ANSI_COLORS['YELLOW']
+BLUE = ANSI_COLORS['BLUE']
+RESET = ANSI_COLORS['RESET']
+
+# ANSI转义序列（颜色、光标控制等），用于生成不含控制字符的输出副本
+_ANSI_RE = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]')
+
+def strip_ansi(text: str) -> str:
+    """去除文本中的ANSI转义序列"""
+    if '\x1b' not in text:
+        return text
+    return _ANSI_RE.sub('', text)
+
+# 帮助文本内容固定，导入时拼好一次
+_HELP_TEXT = (
+    f"{GREEN}可用命令:{RESET}\n"
+    f"  {YELLOW}cd <目录>{RESET} - 切换当前工作目录\n"
+    f"  {YELLOW}pwd{RESET} - 显示当前工作目录\n"
+    f"  {YELLOW}ls{RESET} - 列出当前目录文件\n"
+    f"  {YELLOW}cat <文件>{RESET} - 显示文件内容\n"
+    f"  {YELLOW}mkdir <目录>{RESET} - 创建新目录\n"
+    f"  {YELLOW}rm <文件>{RESET} - 删除文件\n"
+    f"  {YELLOW}clear{RESET} - 清屏\n"
+    f"  {YELLOW}help{RESET} - 显示此帮助信息\n"
+    f"\n{GREEN}键盘快捷键:{RESET}\n"
+    f"  {YELLOW}Enter{RESET} - 执行命令\n"
+    f"  {YELLOW}点击命令{RESET} - 复制命令到输入框\n"
+)
+
+# 出现这些字符的命令需要交给shell解释（管道、重定向、变量、通配符等）
+_SHELL_META = frozenset('|&;<>$`()*?[]{}~#!\n\\')
+
+@lru_cache(maxsize=256)
+def _which(name: str, path: str) -> Optional[str]:
+    """按PATH查找可执行文件，结果缓存"""
+    return shutil.which(name, path=path)
+
+def _direct_argv(command: str, path: str) -> Optional[List[str]]:
+    """返回可以不经shell直接执行的命令参数列表，需要shell时返回None"""
+    if any(c in _SHELL_META for c in command):
+        return None
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        return None
+    # 空命令、变量赋值、路径形式的命令以及shell内建命令/关键字仍交给shell
+    if not argv or '=' in argv[0] or '/' in argv[0] or _which(argv[0], path) is None:
+        return None
+    return argv
+
+# 欢迎消息模板，只有工作目录随会话变化
+_WELCOME_TEMPLATE = (
+    f"{GREEN}欢迎使用终端！{RESET}\n"
+    f"当前工作目录: {BLUE}{{work_dir}}{RESET}\n"
+    f"提示: 使用 {YELLOW}help{RESET} 命令查看可用命令列表\n"
+)
+
+class _OutputBuffer:
+    """Keep the most recent command output up to a size cap, joining chunks only when the text is requested"""
+    
+    def __init__(self, limit: int = MAX_OUTPUT_CHARS):
+        self._chunks = deque()
+        self._size = 0
+        self._dropped = 0
+        self._limit = limit
+    
+    def append(self, text: str) -> None:
+        self._chunks.append(text)
+        self._size += len(text)
+        # 超出上限时丢弃最早的输出，终端更关心最新的内容
+        while self._size > self._limit and len(self._chunks) > 1:
+            old = self._chunks.popleft()
+            self._size -= len(old)
+            self._dropped += len(old)
+    
+    def text(self) -> str:
+        body = ''.join(self._chunks)
+        if self._dropped:
+            return f"{YELLOW}...[输出过长，已省略前 {self._dropped} 个字符]...{RESET}\n" + body
+        return body
+
 class TerminalService:
     """服务用于执行终端命令并管理会话"""
     
     def __init__(self):
         self.sessions = {}  # 存储活跃终端会话
         self.active_processes = {}  # 存储活跃进程
-        self._cleanup_thread = threading.Thread(target=self._cleanup_expired_sessions, daemon=True)
-        self._cleanup_thread.start()
+        self._session_procs = {}  # 会话ID -> 该会话活跃进程ID集合
+        self._conv_sessions = {}  # 对话ID -> 该对话的终端会话ID集合
+        # 保护 sessions / active_processes 及其索引的复合修改（请求线程与过期清理定时器并发）
+        self._lock = threading.RLock()
+        # 每个会话的完整子进程环境只在创建时构建一次；不放进会话字典，避免随会话返回给前端
+        self._session_envs = {}
+        # 命令ID只需在会话内唯一，用每个会话的递增计数代替uuid；进程ID用全局计数
+        self._cmd_seqs = {}
+        self._proc_seq = itertools.count(1)
+        # 已确认存在的会话文件目录，避免每次都调用 os.makedirs
+        self._dir_cache = {}
+        # 过期检查：最小堆按截止时间排序 (deadline, session_id)，只在最早的截止时间唤醒一次定时器
+        self._expiry_heap = []
+        self._expiry_lock = threading.Lock()
+        self._cleanup_timer = None
     
     def create_session(self, conversation_id: str) -> Dict:
         """创建一个新的终端会话"""
         session_id = f"term-{uuid.uuid4().hex[:8]}"
+        # 获取工作目录时已确保其存在
         work_dir = self.get_conversation_files_dir(conversation_id)
         
-        # 确保工作目录存在
-        os.makedirs(work_dir, exist_ok=True)
-        
         session = {
             'id': session_id,
             'conversation_id': conversation_id,
@@ -72,17 +186,20 @@ class TerminalService:
             }
         }
         
-        self.sessions[session_id] = session
+        with self._lock:
+            self.sessions[session_id] = session
+            self._conv_sessions.setdefault(conversation_id, set()).add(session_id)
+        self._session_envs[session_id] = {**os.environ, **session['environment'], 'PWD': work_dir}
+        cmd_seq = self._cmd_seqs[session_id] = itertools.count(1)
+        self._schedule_expiry(session_id, session['last_active'] + SESSION_TTL)
         
         # 添加欢迎消息和帮助提示
         welcome_message = {
-            'id': f"cmd-{uuid.uuid4().hex[:8]}",
+            'id': f"cmd-{session_id}-{next(cmd_seq)}",
             'command': 'welcome',
             'start_time': time.time(),
             'status': 'completed',
-            'output': f"{ANSI_COLORS['GREEN']}欢迎使用终端！{ANSI_COLORS['RESET']}\n"
-                      f"当前工作目录: {ANSI_COLORS['BLUE']}{work_dir}{ANSI_COLORS['RESET']}\n"
-                      f"提示: 使用 {ANSI_COLORS['YELLOW']}help{ANSI_COLORS['RESET']} 命令查看可用命令列表\n",
+            'output': _WELCOME_TEMPLATE.format(work_dir=work_dir),
             'end_time': time.time()
         }
         session['commands'].append(welcome_message)
@@ -91,20 +208,23 @@ class TerminalService:
     
     def execute_command(self, session_id: str, command: str) -> Dict:
         """在指定会话中执行命令"""
-        if session_id not in self.sessions:
+        session = self.sessions.get(session_id)
+        cmd_seq = self._cmd_seqs.get(session_id)
+        if session is None or cmd_seq is None:
             raise ValueError(f"终端会话 {session_id} 不存在")
         
-        session = self.sessions[session_id]
         work_dir = session['working_directory']
         
         # 更新会话活跃时间
         session['last_active'] = time.time()
         
         # 创建日志文件
-        log_file_path = os.path.join(TERMINAL_LOGS_DIR, f"{session_id}_{len(session['commands'])}.log")
+        # 日志文件按命令序号命名，历史被截断后也不会重名
+        seq = next(cmd_seq)
+        log_file_path = os.path.join(TERMINAL_LOGS_DIR, f"{session_id}_{seq}.log")
         
         command_entry = {
-            'id': f"cmd-{uuid.uuid4().hex[:8]}",
+            'id': f"cmd-{session_id}-{seq}",
             'command': command,
             'start_time': time.time(),
             'status': 'running',
@@ -112,254 +232,375 @@ class TerminalService:
         }
         
         # 添加到会话的命令历史
-        session['commands'].append(command_entry)
+        # 会话字典会直接序列化返回给前端，因此保持list，超出上限时删除最早的记录
+        commands = session['commands']
+        commands.append(command_entry)
+        if len(commands) > MAX_SESSION_COMMANDS:
+            del commands[:-MAX_SESSION_COMMANDS]
         
         # 检查内部命令
         try:
-            # 处理特殊内部命令
-            if command.strip() == 'help':
-                # 帮助命令
-                command_entry['output'] = self._generate_help_text()
-                command_entry['status'] = 'completed'
-                command_entry['end_time'] = time.time()
-                return command_entry
-            
-            elif command.strip() == 'clear':
-                # 清屏命令 - 返回特殊标记让前端处理
-                command_entry['output'] = "CLEAR_TERMINAL"
-                command_entry['status'] = 'completed'
-                command_entry['end_time'] = time.time()
-                return command_entry
-            
-            elif command.strip().startswith('cd '):
-                # 切换目录命令
-                target_dir = command.strip()[3:].strip()
-                
-                # 处理相对路径
-                if not os.path.isabs(target_dir):
-                    target_dir = os.path.join(work_dir, target_dir)
-                
-                # 处理家目录符号 ~
-                if target_dir.startswith('~'):
-                    target_dir = os.path.expanduser(target_dir)
-                
-                # 验证目录存在
-                if os.path.isdir(target_dir):
-                    session['working_directory'] = target_dir
-                    command_entry['output'] = f"{ANSI_COLORS['GREEN']}已切换到目录: {ANSI_COLORS['BLUE']}{target_dir}{ANSI_COLORS['RESET']}"
-                    command_entry['status'] = 'completed'
-                    command_entry['end_time'] = time.time()
-                else:
-                    command_entry['output'] = f"{ANSI_COLORS['RED']}错误: 目录 '{target_dir}' 不存在{ANSI_COLORS['RESET']}"
-                    command_entry['status'] = 'failed'
-                    command_entry['end_time'] = time.time()
-                return command_entry
-            
-            elif command.strip() == 'pwd':
-                # 显示当前工作目录
-                command_entry['output'] = work_dir
-                command_entry['status'] = 'completed'
+            # 处理特殊内部命令：只strip一次，按命令名查表分发
+            op, _, arg = command.strip().partition(' ')
+            handler = self._INTERNAL.get(op)
+            result = handler(self, session_id, session, arg.strip()) if handler else None
+            if result is not None:
+                command_entry['output'], command_entry['status'] = result
                 command_entry['end_time'] = time.time()
                 return command_entry
             
             # 执行其他命令
-            with open(log_file_path, 'w') as log_file:
+            # 日志直接写入管道读到的原始字节，绕过文本文件的编码和缓冲层
+            log_fd = os.open(log_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644)
+            try:
                 try:
-                    # 设置环境变量
-                    env = os.environ.copy()
-                    for key, value in session['environment'].items():
-                        env[key] = value
-                    
-                    # 使用shell执行命令
+                    env = self._session_envs[session_id]
+                    # 简单命令直接执行，省去中间的 /bin/sh 进程；含shell语法的命令仍使用shell执行
+                    argv = _direct_argv(command, env.get('PATH', ''))
                     process = subprocess.Popen(
-                        command,
-                        shell=True,
+                        argv if argv is not None else command,
+                        shell=argv is None,
                         stdout=subprocess.PIPE,
                         stderr=subprocess.STDOUT,
                         cwd=work_dir,
-                        text=True,
-                        bufsize=1,
+                        # 输出通过 os.read 直接从fd读取并自行解码，不需要行缓冲的文本包装
+                        bufsize=PIPE_BUFSIZE,
                         env=env,
-                        preexec_fn=os.setsid  # 创建新的进程组以便能够终止整个进程树
+                        # 创建新的会话和进程组以便能够终止整个进程树；不使用preexec_fn，子进程可走vfork快速路径
+                        start_new_session=True
                     )
                     
                     # 存储活跃进程
-                    process_id = f"proc-{uuid.uuid4().hex[:8]}"
-                    self.active_processes[process_id] = {
+                    process_id = f"proc-{next(self._proc_seq)}"
+                    self._register_process(process_id, {
                         'process': process,
                         'command_id': command_entry['id'],
                         'session_id': session_id,
                         'start_time': time.time(),
-                        'process_group': os.getpgid(process.pid)
-                    }
+                        # 子进程是新进程组的组长，pgid 即 pid，无需再调用 os.getpgid
+                        'process_group': process.pid
+                    })
                     
-                    # 设置非阻塞模式
+                    # 用selector等待输出：有数据时立即读取，无输出的命令不再被周期唤醒
                     fd = process.stdout.fileno()
-                    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-                    fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+                    selector = selectors.DefaultSelector()
+                    selector.register(fd, selectors.EVENT_READ)
+                    # 非阻塞读取：一次唤醒读空管道中已有的数据
+                    os.set_blocking(fd, False)
+                    # 增量解码，避免多字节字符被拆在两次读取之间
+                    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
                     
                     # 设置超时时间
                     max_execution_time = 60  # 60秒超时
                     start_time = time.time()
+                    timed_out = False
+                    eof = False
                     
-                    output_lines = []
+                    output = _OutputBuffer()
+                    last_publish = 0.0
                     
-                    # 实时获取命令输出
-                    while process.poll() is None:
-                        # 检查超时
-                        if time.time() - start_time > max_execution_time:
-                            logger.info(f"命令执行超时: {command}")
+                    def emit(chunk: bytes, final: bool = False) -> None:
+                        nonlocal last_publish
+                        if chunk:
+                            os.write(log_fd, chunk)
+                        chunk_str = decoder.decode(chunk, final=final)
+                        if chunk_str:
+                            output.append(chunk_str)
+                            # 更新命令输出以便实时查看；限制频率，避免每个数据块都拼接全部输出
+                            now = time.monotonic()
+                            if now - last_publish >= LIVE_OUTPUT_INTERVAL:
+                                command_entry['output'] = output.text()
+                                last_publish = now
+                    
+                    def drain() -> bool:
+                        """以管道缓冲区大小为块读取所有已就绪的输出，返回是否已到EOF"""
+                        while True:
                             try:
-                                # 终止整个进程组
-                                os.killpg(os.getpgid(process.pid), signal.SIGTERM)
-                                # 等待一小段时间后再发送强制终止信号
-                                time.sleep(0.5)
-                                if process.poll() is None:
-                                    os.killpg(os.getpgid(process.pid), signal.SIGKILL)
-                            except:
-                                logger.exception("终止进程失败")
-                            break
-                        
-                        try:
-                            # 尝试读取输出
-                            chunk = process.stdout.read(4096)
-                            if chunk:
-                                chunk_str = chunk.decode('utf-8', errors='replace') if isinstance(chunk, bytes) else chunk
-                                output_lines.append(chunk_str)
-                                log_file.write(chunk_str)
-                                log_file.flush()
-                                # 更新命令输出以便实时查看
-                                command_entry['output'] = ''.join(output_lines)
-                            else:
-                                time.sleep(0.1)  # 短暂休眠避免CPU占用过高
-                        except Exception as e:
-                            # 没有新数据可读或其他错误
-                            time.sleep(0.1)
+                                chunk = os.read(fd, PIPE_BUFSIZE)
+                            except BlockingIOError:
+                                return False
+                            if not chunk:
+                                return True
+                            emit(chunk)
                     
-                    # 读取剩余输出
+                    # 实时获取命令输出
                     try:
-                        remaining = process.stdout.read()
-                        if remaining:
-                            remaining_str = remaining.decode('utf-8', errors='replace') if isinstance(remaining, bytes) else remaining
-                            output_lines.append(remaining_str)
-                            log_file.write(remaining_str)
-                            log_file.flush()
-                    except:
-                        pass
+                        while True:
+                            remaining = max_execution_time - (time.time() - start_time)
+                            # 检查超时
+                            if remaining <= 0:
+                                if logger.isEnabledFor(logging.INFO):
+                                    logger.info(f"命令执行超时: {command}")
+                                timed_out = True
+                                try:
+                                    # 终止整个进程组
+                                    os.killpg(process.pid, signal.SIGTERM)
+                                    # 进程退出即返回，超过宽限时间再发送强制终止信号
+                                    try:
+                                        process.wait(timeout=TERMINATE_GRACE)
+                                    except subprocess.TimeoutExpired:
+                                        os.killpg(process.pid, signal.SIGKILL)
+                                except:
+                                    logger.exception("终止进程失败")
+                                break
+                            
+                            if eof:
+                                # 输出已关闭，只需等待进程退出
+                                try:
+                                    process.wait(timeout=remaining)
+                                    break
+                                except subprocess.TimeoutExpired:
+                                    continue
+                            
+                            if selector.select(timeout=min(remaining, 1.0)):
+                                eof = drain()
+                            elif process.poll() is not None:
+                                # 进程已退出（后台子进程可能仍持有管道）
+                                break
+                        
+                        # 读取剩余输出（只读取已就绪的数据，不阻塞）
+                        if not eof:
+                            drain()
+                        emit(b'', final=True)
+                    finally:
+                        selector.close()
+                        process.stdout.close()
                     
                     # 清理进程记录
-                    if process_id in self.active_processes:
-                        del self.active_processes[process_id]
+                    self.remove_process(process_id)
                     
                     # 等待进程完成
                     return_code = process.returncode if process.returncode is not None else -1
                     
-                    command_entry['output'] = ''.join(output_lines)
+                    command_entry['output'] = output.text()
                     command_entry['end_time'] = time.time()
                     
-                    if time.time() - start_time > max_execution_time:
+                    if timed_out:
                         command_entry['status'] = 'timeout'
-                        command_entry['output'] += f"\n{ANSI_COLORS['RED']}命令执行超时 ({max_execution_time}秒){ANSI_COLORS['RESET']}"
+                        command_entry['output'] += f"\n{RED}命令执行超时 ({max_execution_time}秒){RESET}"
                     elif return_code == 0:
                         command_entry['status'] = 'completed'
                     else:
                         command_entry['status'] = 'failed'
                         if not command_entry['output']:
-                            command_entry['output'] = f"{ANSI_COLORS['RED']}命令执行失败，返回代码: {return_code}{ANSI_COLORS['RESET']}"
+                            command_entry['output'] = f"{RED}命令执行失败，返回代码: {return_code}{RESET}"
                     
                 except Exception as e:
                     logger.exception(f"执行命令时出错: {command}")
                     command_entry['status'] = 'failed'
-                    command_entry['output'] = f"{ANSI_COLORS['RED']}执行错误: {str(e)}{ANSI_COLORS['RESET']}"
+                    command_entry['output'] = f"{RED}执行错误: {str(e)}{RESET}"
                     command_entry['end_time'] = time.time()
+            finally:
+                os.close(log_fd)
         
         except Exception as e:
             logger.exception(f"处理命令时出错: {command}")
             command_entry['status'] = 'failed'
-            command_entry['output'] = f"{ANSI_COLORS['RED']}执行错误: {str(e)}{ANSI_COLORS['RESET']}"
+            command_entry['output'] = f"{RED}执行错误: {str(e)}{RESET}"
             command_entry['end_time'] = time.time()
         
         return command_entry
     
-    def _generate_help_text(self) -> str:
-        """生成帮助文本"""
-        help_text = f"{ANSI_COLORS['GREEN']}可用命令:{ANSI_COLORS['RESET']}\n"
-        help_text += f"  {ANSI_COLORS['YELLOW']}cd <目录>{ANSI_COLORS['RESET']} - 切换当前工作目录\n"
-        help_text += f"  {ANSI_COLORS['YELLOW']}pwd{ANSI_COLORS['RESET']} - 显示当前工作目录\n"
-        help_text += f"  {ANSI_COLORS['YELLOW']}ls{ANSI_COLORS['RESET']} - 列出当前目录文件\n"
-        help_text += f"  {ANSI_COLORS['YELLOW']}cat <文件>{ANSI_COLORS['RESET']} - 显示文件内容\n"
-        help_text += f"  {ANSI_COLORS['YELLOW']}mkdir <目录>{ANSI_COLORS['RESET']} - 创建新目录\n"
-        help_text += f"  {ANSI_COLORS['YELLOW']}rm <文件>{ANSI_COLORS['RESET']} - 删除文件\n"
-        help_text += f"  {ANSI_COLORS['YELLOW']}clear{ANSI_COLORS['RESET']} - 清屏\n"
-        help_text += f"  {ANSI_COLORS['YELLOW']}help{ANSI_COLORS['RESET']} - 显示此帮助信息\n"
+    def _cmd_help(self, session_id: str, session: Dict, arg: str) -> Optional[Tuple[str, str]]:
+        """帮助命令"""
+        if arg:
+            return None
+        return self._generate_help_text(), 'completed'
+    
+    def _cmd_clear(self, session_id: str, session: Dict, arg: str) -> Optional[Tuple[str, str]]:
+        """清屏命令 - 返回特殊标记让前端处理"""
+        if arg:
+            return None
+        return "CLEAR_TERMINAL", 'completed'
+    
+    def _cmd_pwd(self, session_id: str, session: Dict, arg: str) -> Optional[Tuple[str, str]]:
+        """显示当前工作目录"""
+        if arg:
+            return None
+        return session['working_directory'], 'completed'
+    
+    def _cmd_cd(self, session_id: str, session: Dict, arg: str) -> Optional[Tuple[str, str]]:
+        """切换目录命令"""
+        if not arg:
+            return None
+        # 先展开家目录符号 ~，再处理相对路径，否则 ~ 会被拼接到工作目录之后
+        target_dir = os.path.expanduser(arg)
         
-        help_text += f"\n{ANSI_COLORS['GREEN']}键盘快捷键:{ANSI_COLORS['RESET']}\n"
-        help_text += f"  {ANSI_COLORS['YELLOW']}Enter{ANSI_COLORS['RESET']} - 执行命令\n"
-        help_text += f"  {ANSI_COLORS['YELLOW']}点击命令{ANSI_COLORS['RESET']} - 复制命令到输入框\n"
+        # 处理相对路径，并规范化 .. 等片段，避免保存的工作目录越来越长
+        if not os.path.isabs(target_dir):
+            target_dir = os.path.normpath(os.path.join(session['working_directory'], target_dir))
         
-        return help_text
+        # 验证目录存在
+        if os.path.isdir(target_dir):
+            session['working_directory'] = target_dir
+            self._session_envs[session_id]['PWD'] = target_dir
+            return f"{GREEN}已切换到目录: {BLUE}{target_dir}{RESET}", 'completed'
+        return f"{RED}错误: 目录 '{target_dir}' 不存在{RESET}", 'failed'
+    
+    # 内部命令：命令名 -> 处理函数，处理函数返回 (输出, 状态)，返回None表示交给shell执行
+    _INTERNAL = {
+        'help': _cmd_help,
+        'clear': _cmd_clear,
+        'pwd': _cmd_pwd,
+        'cd': _cmd_cd
+    }
+    
+    def _generate_help_text(self) -> str:
+        """生成帮助文本"""
+        return _HELP_TEXT
     
     def get_session(self, session_id: str) -> Dict:
         """获取会话信息"""
-        if session_id not in self.sessions:
+        session = self.sessions.get(session_id)
+        if session is None:
             raise ValueError(f"终端会话 {session_id} 不存在")
-        self.sessions[session_id]['last_active'] = time.time()  # 更新活跃时间
-        return self.sessions[session_id]
+        session['last_active'] = time.time()  # 更新活跃时间
+        return session
+    
+    def get_command_output(self, session_id: str, command_id: str, plain: bool = False) -> str:
+        """获取命令输出；plain为True时去除ANSI转义序列，供搜索、导出等非终端场景按需使用"""
+        session = self.get_session(session_id)
+        for command_entry in reversed(session['commands']):
+            if command_entry['id'] == command_id:
+                output = command_entry['output']
+                return strip_ansi(output) if plain else output
+        raise ValueError(f"命令 {command_id} 不存在")
     
     def get_conversation_sessions(self, conversation_id: str) -> List[Dict]:
         """获取会话列表"""
-        result = [
-            session for session in self.sessions.values() 
-            if session['conversation_id'] == conversation_id
-        ]
+        with self._lock:
+            result = [self.sessions[sid] for sid in self._conv_sessions.get(conversation_id, ())]
         # 按最新活跃时间排序
         result.sort(key=lambda s: s['last_active'], reverse=True)
         return result
     
     def terminate_session(self, session_id: str) -> bool:
         """终止会话"""
-        if session_id in self.sessions:
-            # 终止会话中的所有活跃进程
-            for pid, proc_info in list(self.active_processes.items()):
-                if proc_info['session_id'] == session_id:
-                    try:
-                        # 尝试终止整个进程组
-                        os.killpg(proc_info['process_group'], signal.SIGTERM)
-                        # 等待一小段时间后再发送强制终止信号
-                        time.sleep(0.5)
-                        os.killpg(proc_info['process_group'], signal.SIGKILL)
-                    except:
-                        # 如果进程组终止失败，尝试直接终止进程
-                        try:
-                            proc_info['process'].kill()
-                        except:
-                            pass
-                    del self.active_processes[pid]
-            
-            del self.sessions[session_id]
-            return True
-        return False
+        with self._lock:
+            session = self.sessions.pop(session_id, None)
+            if session is None:
+                return False
+            conv_sessions = self._conv_sessions.get(session['conversation_id'])
+            if conv_sessions is not None:
+                conv_sessions.discard(session_id)
+                if not conv_sessions:
+                    del self._conv_sessions[session['conversation_id']]
+            self._session_envs.pop(session_id, None)
+            self._cmd_seqs.pop(session_id, None)
+            procs = self.session_processes(session_id)
+        
+        # 终止会话中的所有活跃进程
+        self.terminate_processes(procs)
+        for pid, _ in procs:
+            self.remove_process(pid)
+        return True
+    
+    def terminate_processes(self, procs: List[Tuple[str, Dict]]) -> List[str]:
+        """终止一组进程：先统一发送SIGTERM，再共用一次等待，仍未退出的进程组才发送SIGKILL
+        
+        返回已终止的进程ID列表
+        """
+        terminated = []
+        pending = []
+        for pid, proc_info in procs:
+            try:
+                # 尝试终止整个进程组
+                os.killpg(proc_info['process_group'], signal.SIGTERM)
+                pending.append((pid, proc_info))
+            except Exception:
+                # 如果进程组终止失败，尝试直接终止进程
+                try:
+                    proc_info['process'].kill()
+                    terminated.append(pid)
+                except Exception:
+                    pass
+        
+        deadline = time.monotonic() + TERMINATE_GRACE
+        for pid, proc_info in pending:
+            try:
+                proc_info['process'].wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                try:
+                    os.killpg(proc_info['process_group'], signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            terminated.append(pid)
+        return terminated
+    
+    def _register_process(self, process_id: str, proc_info: Dict) -> None:
+        """登记活跃进程"""
+        with self._lock:
+            self.active_processes[process_id] = proc_info
+            self._session_procs.setdefault(proc_info['session_id'], set()).add(process_id)
+    
+    def remove_process(self, process_id: str) -> None:
+        """移除活跃进程记录，重复移除是安全的"""
+        with self._lock:
+            proc_info = self.active_processes.pop(process_id, None)
+            if proc_info is None:
+                return
+            procs = self._session_procs.get(proc_info['session_id'])
+            if procs is not None:
+                procs.discard(process_id)
+                if not procs:
+                    del self._session_procs[proc_info['session_id']]
+    
+    def session_processes(self, session_id: str) -> List[Tuple[str, Dict]]:
+        """获取会话中的活跃进程 (进程ID, 进程信息) 列表"""
+        with self._lock:
+            return [(pid, self.active_processes[pid]) for pid in self._session_procs.get(session_id, ())]
     
     def get_conversation_files_dir(self, conversation_id: str) -> str:
         """获取会话文件目录"""
+        cached = self._dir_cache.get(conversation_id)
+        if cached:
+            return cached
         conversation_files_dir = os.path.join(FILES_DIR, conversation_id)
         os.makedirs(conversation_files_dir, exist_ok=True)
+        self._dir_cache[conversation_id] = conversation_files_dir
         return conversation_files_dir
     
+    def _schedule_expiry(self, session_id: str, deadline: float) -> None:
+        """登记会话的过期时间，必要时提前定时器"""
+        with self._expiry_lock:
+            heapq.heappush(self._expiry_heap, (deadline, session_id))
+            if self._expiry_heap[0][1] == session_id:
+                self._arm_cleanup_timer()
+    
+    def _arm_cleanup_timer(self) -> None:
+        """按堆顶的截止时间重新设置定时器，调用方需持有 _expiry_lock"""
+        if self._cleanup_timer is not None:
+            self._cleanup_timer.cancel()
+            self._cleanup_timer = None
+        if self._expiry_heap:
+            delay = max(0.0, self._expiry_heap[0][0] - time.time())
+            self._cleanup_timer = threading.Timer(delay, self._cleanup_expired_sessions)
+            self._cleanup_timer.daemon = True
+            self._cleanup_timer.start()
+    
     def _cleanup_expired_sessions(self):
         """清理过期的会话 (1小时无活动)"""
-        while True:
+        expired_sessions = []
+        with self._expiry_lock:
+            current_time = time.time()
+            while self._expiry_heap and self._expiry_heap[0][0] <= current_time:
+                _, session_id = heapq.heappop(self._expiry_heap)
+                session = self.sessions.get(session_id)
+                if session is None:
+                    continue
+                # 堆中的截止时间可能已过时：会话期间有活动则按最新活跃时间重新入堆
+                deadline = session['last_active'] + SESSION_TTL
+                if deadline > current_time:
+                    heapq.heappush(self._expiry_heap, (deadline, session_id))
+                else:
+                    expired_sessions.append(session_id)
+            self._cleanup_timer = None
+            self._arm_cleanup_timer()
+        
+        for session_id in expired_sessions:
             try:
-                time.sleep(300)  # 每5分钟检查一次
-                current_time = time.time()
-                expired_sessions = []
-                
-                for session_id, session in list(self.sessions.items()):
-                    if current_time - session['last_active'] > 3600:  # 1小时超时
-                        expired_sessions.append(session_id)
-                
-                for session_id in expired_sessions:
+                if logger.isEnabledFor(logging.INFO):
                     logger.info(f"清理过期会话: {session_id}")
-                    self.terminate_session(session_id)
+                self.terminate_session(session_id)
             except Exception as e:
-                logger.error(f"清理过期会话时出错: {e}") 
\ No newline at end of file
+                logger.error(f"清理过期会话时出错: {e}")